@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the hot paths. Repetitions are timed with `time.perf_counter_ns()`
+and also run in a `Timer` section per benchmark, so they show in its profile (`run --profile`).
+
+A benchmark is a function named `bench_<name>` that does its setup and returns
+the function to time (called without arguments), or a generator function yielding
+it once and cleaning up after the yield. Benchmarks raising ImportError
+(eg. for a missing optional dependency) are skipped.
+
+Results are stored as JSON in `<results dir>/<machine>/<git revision>.json`,
+compare against a baseline to find significant slowdowns:
+
+    python -m <package>.benchmark run
+    python -m <package>.benchmark compare <baseline revision or file> [<revision or file>]
+"""
+
+import os
+import io
+import sys
+import json
+import math
+import time
+import fnmatch
+import hashlib
+import inspect
+import platform
+import datetime
+import subprocess
+import contextlib
+
+from .timer import Timer
+from .text import format_table
+
+RESULTS_DIR = '.benchmarks'
+
+# Benchmarks
+
+def bench_cache_hash():
+    from .hashing import cache_hash
+    obj = {
+        'name': 'experiment',
+        'rows': [list(range(i, i + 20)) for i in range(50)],
+        'labels': ['label{}'.format(i) for i in range(100)],
+    }
+    return lambda: cache_hash(obj)
+
+def bench_cached_hit():
+    import shutil
+    import tempfile
+    from . import cache
+
+    base_directory = cache.base_directory
+    cache.base_directory = tempfile.mkdtemp()
+    try:
+        @cache.cached()
+        def square(x):
+            return x * x
+        square(x=5)
+        yield lambda: square(x=5)
+    finally:
+        shutil.rmtree(cache.base_directory)
+        cache.base_directory = base_directory
+
+def bench_dataframe_get_range():
+    import numpy as np
+    from .dataframe import DataFrame
+
+    rng = np.random.default_rng(0)
+    df = DataFrame(data={'t': np.arange(1_000_000), 'v': rng.random(1_000_000)})
+    df.make_index('t', is_sorted=True)
+    return lambda: df.get_range(250_000, 260_000)
+
+def bench_t_average():
+    from .time_series import t_average
+    series = [(t * .01, float(t % 100)) for t in range(10_000)]
+    return lambda: list(t_average(series, 1.))
+
+def bench_dtw():
+    from .sequence import dtw
+    seq1 = [math.sin(i / 10) for i in range(200)]
+    seq2 = [math.sin(i / 11) for i in range(220)]
+    return lambda: dtw(seq1, seq2, distance=lambda a, b: abs(a - b))
+
+def bench_ijson_parser():
+    from .ijsonutils import IjsonParser, ijson
+    data = json.dumps([
+        {'id': i, 'name': 'item{}'.format(i), 'tags': ['a', 'b'], 'pos': {'lat': 1.5, 'lon': 2.5}}
+        for i in range(1000)
+    ]).encode()
+    return lambda: list(IjsonParser(ijson.basic_parse(io.BytesIO(data))).parse_all())
+
+def bench_kalman_filter():
+    import numpy as np
+    import pandas as pd
+    from .traces.kalman import kalman_filter
+
+    t = np.arange(100.)
+    path = pd.DataFrame({
+        't': t, 'lat': 48 + t * 1e-5, 'lon': 11 + t * 1e-5,
+        'vlat': np.full_like(t, 1e-5), 'vlon': np.full_like(t, 1e-5),
+    })
+    def run():
+        # kalman_filter prints its input
+        with contextlib.redirect_stdout(io.StringIO()):
+            return kalman_filter(path, .5)
+    return run
+
+def discover(modules=None, pattern='*'):
+    """
+    {name: benchmark function} of the `bench_*` functions in `modules` (default: this one)
+    whose name (without the prefix) matches the fnmatch `pattern`.
+    """
+    if modules is None:
+        modules = [sys.modules[__name__]]
+    benchmarks = {}
+    for module in modules:
+        for name, f in inspect.getmembers(module, inspect.isfunction):
+            if name.startswith('bench_') and fnmatch.fnmatch(name[len('bench_'):], pattern):
+                benchmarks[name[len('bench_'):]] = f
+    return benchmarks
+
+# Running
+
+def median(a):
+    a = sorted(a)
+    n = len(a)
+    return (a[(n - 1) // 2] + a[n // 2]) / 2
+
+def mad(a):
+    """
+    Median absolute deviation.
+    """
+    m = median(a)
+    return median([abs(x - m) for x in a])
+
+def run_benchmark(name, bench, repeat=20, warmup=3, min_time=.01):
+    """
+    Time the function returned by `bench` in `repeat` repetitions after `warmup` ones.
+    Each repetition calls it often enough to take at least `min_time` seconds.
+    Returns a dict with the seconds per call of each repetition and their statistics.
+    """
+    if inspect.isgeneratorfunction(bench):
+        with contextlib.contextmanager(bench)() as f:
+            return _time(name, f, repeat, warmup, min_time)
+    return _time(name, bench(), repeat, warmup, min_time)
+
+def _time(name, f, repeat, warmup, min_time):
+
+    # Calibrate the number of calls per repetition
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            f()
+        if time.perf_counter() - t >= min_time:
+            break
+        number *= 2
+
+    # Samples are exact, the section's latency histogram would bucket them
+    timer = Timer('benchmark ' + name)
+    samples = []
+    for i in range(warmup + repeat):
+        with timer:
+            t = time.perf_counter_ns()
+            for _ in range(number):
+                f()
+            t = time.perf_counter_ns() - t
+        if i >= warmup:
+            samples.append(t * 1e-9 / number)
+
+    return {
+        'samples': samples, 'number': number,
+        'median': median(samples), 'mad': mad(samples), 'min': min(samples),
+    }
+
+def run(benchmarks, repeat=20, warmup=3, min_time=.01, log=print):
+    """
+    Run `benchmarks` ({name: benchmark}), returns {name: result} (see `run_benchmark()`),
+    skipped benchmarks have {'skipped': reason}, failing ones {'error': message}.
+    """
+    results = {}
+    for name, bench in sorted(benchmarks.items()):
+        try:
+            results[name] = run_benchmark(name, bench, repeat, warmup, min_time)
+        except ImportError as e:
+            results[name] = {'skipped': str(e)}
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+        log(format_result(name, results[name]))
+    return results
+
+def format_result(name, result):
+    if 'skipped' in result:
+        return '{}: skipped ({})'.format(name, result['skipped'])
+    if 'error' in result:
+        return '{}: error ({})'.format(name, result['error'])
+    return '{}: {:.3g}s ± {:.2g}s (median ± MAD of {} x {} calls)'.format(
+        name, result['median'], result['mad'], len(result['samples']), result['number']
+    )
+
+# Storing
+
+def git_revision(path=None):
+    """
+    Git revision of the working tree at `path` (default: of this module),
+    suffixed with '-dirty' for uncommitted changes, None outside of git.
+    """
+    path = path or os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=path, stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+def machine_info():
+    return {
+        'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(),
+        'system': platform.system(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+    }
+
+def machine_id(info=None):
+    """
+    Short name of this machine (host name and a hash of its hardware and software).
+    """
+    info = info or machine_info()
+    h = hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()[:8]
+    return '{}-{}'.format(info['node'] or 'unknown', h)
+
+def save_results(results, results_dir=RESULTS_DIR, revision=None):
+    """
+    Store `results` of this machine and `revision` (default: current), returns the filename.
+    """
+    revision = revision or git_revision() or 'unknown'
+    info = machine_info()
+    filename = os.path.join(results_dir, machine_id(info), revision + '.json')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump({
+            'revision': revision, 'machine': info, 'machine_id': machine_id(info),
+            'time': datetime.datetime.now().isoformat(), 'results': results,
+        }, f, indent=1)
+    return filename
+
+def load_results(name, results_dir=RESULTS_DIR):
+    """
+    Stored results by filename or by revision (of this machine).
+    """
+    if not os.path.exists(name):
+        name = os.path.join(results_dir, machine_id(), name + '.json')
+    with open(name) as f:
+        return json.load(f)
+
+# Comparing
+
+def mann_whitney_u(a, b):
+    """
+    Two-sided Mann-Whitney U test (normal approximation with tie correction),
+    returns (U of `a`, p-value).
+
+    >>> u, p = mann_whitney_u([1, 2, 3, 4, 5, 6, 7, 8], [9, 10, 11, 12, 13, 14, 15, 16])
+    >>> u, p < .001
+    (0.0, True)
+    >>> u, p = mann_whitney_u([1, 3, 5, 7], [2, 4, 6, 8])
+    >>> p > .5
+    True
+    """
+    n1, n2 = len(a), len(b)
+    values = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+
+    # Ranks, averaged over ties
+    ranks = [0.] * len(values)
+    tie_term = 0
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        tie_term += t ** 3 - t
+        i = j + 1
+
+    r1 = sum(r for r, (_, group) in zip(ranks, values) if group == 0)
+    u = r1 - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    if sigma == 0:
+        return u, 1.
+    z = (abs(u - n1 * n2 / 2) - .5) / sigma
+    return u, min(1., math.erfc(max(z, 0) / math.sqrt(2)))
+
+def compare(baseline, current, alpha=.01, threshold=.05):
+    """
+    Yield (name, baseline median, current median, ratio, p-value, verdict) per benchmark in both,
+    verdict being 'slower' or 'faster' if the difference is significant at `alpha`
+    and more than `threshold` (relative), else ''.
+    """
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        b = baseline['results'][name]
+        c = current['results'][name]
+        if 'samples' not in b or 'samples' not in c:
+            continue
+        _, p = mann_whitney_u(b['samples'], c['samples'])
+        ratio = c['median'] / b['median']
+        verdict = ''
+        if p < alpha and abs(ratio - 1) > threshold:
+            verdict = 'slower' if ratio > 1 else 'faster'
+        yield name, b['median'], c['median'], ratio, p, verdict
+
+def format_comparison(comparison):
+    return format_table(
+        [
+            (name, '{:.3g}'.format(b), '{:.3g}'.format(c), '{:.3f}'.format(ratio), '{:.2g}'.format(p), verdict)
+            for name, b, c, ratio, p, verdict in comparison
+        ],
+        ('benchmark', 'baseline', 'current', 'ratio', 'p', '')
+    )
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run and compare benchmarks of the hot paths')
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help='where results are stored')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('run', help='run benchmarks and store the results')
+    p.add_argument('-k', '--pattern', default='*', help='only run benchmarks matching this fnmatch pattern')
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--warmup', type=int, default=3)
+    p.add_argument('--min-time', type=float, default=.01, help='minimum seconds per repetition')
+    p.add_argument('--revision', help='store as this revision instead of the current git revision')
+    p.add_argument('--profile', action='store_true', help='print the Timer profile afterwards')
+
+    p = subparsers.add_parser('compare', help='compare results against a baseline, fail on regressions')
+    p.add_argument('baseline', help='revision (of this machine) or results file')
+    p.add_argument('current', nargs='?', help='revision or results file, default: current revision')
+    p.add_argument('--alpha', type=float, default=.01, help='significance level')
+    p.add_argument('--threshold', type=float, default=.05, help='minimum relative change to report')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(discover(pattern=args.pattern), args.repeat, args.warmup, args.min_time)
+        print('Saved to', save_results(results, args.results_dir, args.revision))
+        if args.profile:
+            print(Timer.format_profile())
+        return 0
+
+    baseline = load_results(args.baseline, args.results_dir)
+    current = load_results(args.current or git_revision() or 'unknown', args.results_dir)
+    comparison = list(compare(baseline, current, args.alpha, args.threshold))
+    print(format_comparison(comparison))
+    return 1 if any(verdict == 'slower' for *_, verdict in comparison) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,7 @@ import time
 import shutil
 import logging
 import inspect
+from collections import Counter
 
 try:
     import pandas as pd
@@ -20,6 +21,17 @@ READ_CACHE = True
 
 base_directory = os.path.abspath('_cache')
 
+# Calls of `cached` functions answered from / not found in the cache,
+# by qualified function name (`<module>.<qualname>`)
+hits = Counter()
+misses = Counter()
+
+def get_hit_rates():
+    """
+    {qualified function name: (hits, misses)} of `cached` functions called so far.
+    """
+    return {name: (hits[name], misses[name]) for name in set(hits) | set(misses)}
+
 def add_arguments(parser):
 
     parser.add_argument(
@@ -233,6 +245,8 @@ def cached(filename_kws=(), ignore_kws=(), add_filenames=(), cache_if=ALWAYS,
     25
     >>> f(x = 2)
     4
+    >>> get_hit_rates()[__name__ + '.f']
+    (3, 2)
     """
 
     def decorate(f):
@@ -244,6 +258,9 @@ def cached(filename_kws=(), ignore_kws=(), add_filenames=(), cache_if=ALWAYS,
             if v.default is not inspect.Parameter.empty
         }
 
+        # Functions of the same name in different modules or classes are counted apart
+        name = f.__module__ + '.' + f.__qualname__
+
         def new_f(**kws):
             add_filenames_ = add_filenames
             default_kws.update(kws)
@@ -265,6 +282,7 @@ def cached(filename_kws=(), ignore_kws=(), add_filenames=(), cache_if=ALWAYS,
 
             cache_result, cache_data = _get_from_cache(cache_path, f, mapped_kws, filenames)
             if cache_result == CACHE_AVAILABLE:
+                hits[name] += 1
                 logging.debug("answering {}({}) from {}".format(f.__name__, mapped_kws, cache_path))
                 e = cache_data.get('exception', None)
                 if e is not None:
@@ -273,6 +291,7 @@ def cached(filename_kws=(), ignore_kws=(), add_filenames=(), cache_if=ALWAYS,
 
             # Compute
 
+            misses[name] += 1
             exception = None
             if compute_if(mapped_kws):
                 t = time.time()
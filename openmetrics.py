@@ -0,0 +1,133 @@
+"""
+Live `Timer` and cache metrics in Prometheus / OpenMetrics text format,
+optionally served over HTTP from a daemon thread:
+
+    server = MetricsServer(port=9100)
+    ...
+    server.close()
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .timer import Timer
+from . import cache
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.,
+)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()) + '}'
+
+def generate_metrics(openmetrics=True, buckets=LATENCY_BUCKETS):
+    """
+    Metrics text of the `Timer` sections (calls, total time and latency histogram,
+    including profiles merged from workers) and the hit rates of `cached` functions,
+    labelled with their qualified name (`<module>.<qualname>`).
+
+    openmetrics: OpenMetrics format, else Prometheus text format 0.0.4
+
+    >>> Timer.reset()
+    >>> with Timer("handle request"):
+    ...     pass
+    >>> text = generate_metrics()
+    >>> print(text[:text.index('# TYPE timer_section_seconds')].strip())
+    # TYPE timer_section_calls counter
+    # HELP timer_section_calls Number of times the section ended
+    timer_section_calls_total{section="handle request"} 1
+    >>> 'timer_section_latency_seconds_bucket{section="handle request",le="+Inf"} 1' in text
+    True
+    >>> text.endswith('# EOF\\n')
+    True
+    """
+    lines = []
+    def family(name, type_, help_):
+        # In the Prometheus format the type is declared for the sample name
+        suffix = '_total' if type_ == 'counter' and not openmetrics else ''
+        lines.append('# TYPE {}{} {}'.format(name, suffix, type_))
+        lines.append('# HELP {}{} {}'.format(name, suffix, help_))
+
+    stats = list(Timer.get_stats())
+
+    family('timer_section_calls', 'counter', 'Number of times the section ended')
+    for name, tot, calls in stats:
+        lines.append('timer_section_calls_total{} {}'.format(_labels(section=name), calls))
+
+    family('timer_section_seconds', 'counter', 'Total time spent in the section (recursion counted once)')
+    for name, tot, calls in stats:
+        lines.append('timer_section_seconds_total{} {!r}'.format(_labels(section=name), tot))
+
+    family('timer_section_latency_seconds', 'histogram', 'Duration of calls of the section')
+    for name, h in sorted(Timer.get_latencies().items()):
+        for le in buckets:
+            lines.append('timer_section_latency_seconds_bucket{} {}'.format(
+                _labels(section=name, le=repr(le)), h.count_at_most(int(le * 1e9))
+            ))
+        lines.append('timer_section_latency_seconds_bucket{} {}'.format(_labels(section=name, le='+Inf'), h.count))
+        lines.append('timer_section_latency_seconds_count{} {}'.format(_labels(section=name), h.count))
+        lines.append('timer_section_latency_seconds_sum{} {!r}'.format(_labels(section=name), h.total * 1e-9))
+
+    rates = sorted(cache.get_hit_rates().items())
+    family('cache_hits', 'counter', 'Calls of cached functions answered from the cache')
+    for name, (hits, misses) in rates:
+        lines.append('cache_hits_total{} {}'.format(_labels(function=name), hits))
+    family('cache_misses', 'counter', 'Calls of cached functions computed')
+    for name, (hits, misses) in rates:
+        lines.append('cache_misses_total{} {}'.format(_labels(function=name), misses))
+    family('cache_hit_ratio', 'gauge', 'Share of calls of cached functions answered from the cache')
+    for name, (hits, misses) in rates:
+        lines.append('cache_hit_ratio{} {!r}'.format(_labels(function=name), hits / (hits + misses)))
+
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = generate_metrics(openmetrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer:
+    """
+    Serve `generate_metrics()` at /metrics over HTTP from a daemon thread, in OpenMetrics
+    format if the client accepts it (as Prometheus does), else in Prometheus text format.
+    Port 0 picks a free port, see `port`.
+    """
+
+    def __init__(self, port=9100, host='127.0.0.1'):
+        self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -24,6 +24,18 @@ def find_recursive(directory, pattern):
         for filename in fnmatch.filter(filenames, pattern):
             yield os.path.join(root, filename)
 
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss():
+    """
+    Current resident memory of this process in bytes, None if unknown (not on Linux).
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
 def free_ram():
     with open('/proc/meminfo', 'r') as f:
         for line in f:
@@ -1,18 +1,34 @@
 
+import os
+import pickle
+import hashlib
+from functools import partial
+
 from hashing import cache_hash
 
+from .fingerprint import code_fingerprint
+
 class Unknown:
     @classmethod
     def __bool__(cls, self):
         return False
 
 class Value:
-    def __init__(self, value=Unknown, hash_=Unknown):
+    def __init__(self, value=Unknown, hash_=Unknown, loader=None):
+        """
+        value:  The actual value if already in memory
+        hash_:  The hash of the value if already known
+        loader: Callable that produces the value on first `load_value()`,
+                the result is kept so it is loaded at most once.
+        """
         self._hash = hash_
         self._value = value
+        self._loader = loader
 
     def load_value(self):
-        assert self._value is not Unknown
+        if self._value is Unknown:
+            assert self._loader is not None
+            self._value = self._loader()
         return self._value
 
     def get_hash(self):
@@ -23,6 +39,72 @@ class Value:
     def cache_hash(self):
         return self.get_hash()
 
+    def describe(self):
+        return repr(self.load_value())
+
+def load_file(path):
+    """
+    Default loader of `FileValue`: `.npy` files are memory-mapped (copy-on-write),
+    everything else is unpickled.
+    """
+    if path.endswith('.npy'):
+        import numpy as np
+        return np.load(path, mmap_mode='c')
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+class FileValue(Value):
+    """
+    Input value stored in a file. It is hashed by path, size and modification time
+    instead of by content and loaded lazily, so large inputs can be passed to
+    calls without being read or hashed on every run.
+    """
+    def __init__(self, path, loader=load_file, fingerprint=False):
+        """
+        loader:      Called with the path to load the value
+        fingerprint: Also hash the file content (this reads the whole file on every
+                     run but catches changes that keep size and modification time)
+        """
+        self.path = os.path.abspath(path)
+        self.fingerprint = fingerprint
+        super().__init__(loader=partial(loader, self.path))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r})'
+
+    def describe(self):
+        return repr(self)
+
+    def get_hash(self):
+        if self._hash is Unknown:
+            st = os.stat(self.path)
+            h = hashlib.blake2b(digest_size=8)
+            path = os.fsencode(self.path)
+            h.update(len(path).to_bytes(8, 'big') + path)
+            h.update(st.st_size.to_bytes(8, 'big') + st.st_mtime_ns.to_bytes(16, 'big', signed=True))
+            if self.fingerprint:
+                with open(self.path, 'rb') as f:
+                    for block in iter(partial(f.read, 1 << 20), b''):
+                        h.update(block)
+            self._hash = int.from_bytes(h.digest(), 'big')
+        return self._hash
+
+def _memmap(path, **kws):
+    import numpy as np
+    return np.memmap(path, **kws)
+
+class MemmapValue(FileValue):
+    """
+    `FileValue` of a raw binary array file, loaded as `numpy.memmap`
+    (copy-on-write by default).
+    """
+    def __init__(self, path, dtype, shape=None, offset=0, mode='c', fingerprint=False):
+        super().__init__(
+            path,
+            loader=partial(_memmap, dtype=dtype, shape=shape, offset=offset, mode=mode),
+            fingerprint=fingerprint
+        )
+
 class Call:
     def __init__(self, op, args, kws):
         self.operation = op
@@ -35,16 +117,44 @@ class Call:
     def cache_hash(self):
         return cache_hash(self.operation)
 
+class MapCall(Call):
+    """
+    Call of an operation for each element of `args[0]` (a sequence), or for each
+    chunk of `chunk_size` rows if `chunk_size` is given (eg. for numpy arrays).
+    Every element is cached under its own key, the result is the list of element
+    results (or their concatenation for chunks).
+    """
+    def __init__(self, op, args, kws, chunk_size=None):
+        super().__init__(op, args, kws)
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return f'{str(self.operation)}.map(args={self.args}, kws={self.kws})'
+
+    def split(self, items):
+        if self.chunk_size is None:
+            return list(items)
+        return [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+
+    def join(self, values):
+        if self.chunk_size is None:
+            return values
+        import numpy as np
+        return np.concatenate(values)
+
 class CallExecution:
     def __init__(self, call, args, kws):
         self.call = call
         self.args = args
         self.kws = kws
 
-    def compute(self):
+    def load_inputs(self):
         args_values = [a.load_value() for a in self.args]
         kws_values = {k: v.load_value() for k, v in self.kws.items()}
+        return args_values, kws_values
 
+    def compute(self):
+        args_values, kws_values = self.load_inputs()
         return Value(value=self.call.operation.compute(args_values, kws_values))
 
     def __repr__(self):
@@ -60,23 +170,67 @@ class CallExecution:
     def get_metadata(self, args, kws):
         return {
             'function': self.call.operation.f.__qualname__,
-            'args': [repr(a.load_value()) for a in args],
-            'kws': {k: repr(v.load_value()) for k, v in kws.items()},
+            'args': [a.describe() for a in args],
+            'kws': {k: v.describe() for k, v in kws.items()},
         }
 
+def _load_operation(module, qualname, version, memory, threads):
+    import importlib
+
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    if isinstance(obj, Operation):
+        return obj
+    return Operation(obj, version=version, memory=memory, threads=threads)
+
 class Operation:
-    def __init__(self, f):
+    def __init__(self, f, version=None, memory=None, threads=1):
+        """
+        f:       The function to call
+        version: If given, results are cached by this (and the name of `f`) instead
+                 of by the fingerprint of its code (see `code_fingerprint()`),
+                 bump it to invalidate cached results.
+        memory:  Expected peak memory use in bytes (see `MemoryScheduler`),
+                 if None it is learned from previous runs.
+        threads: Number of threads the operation keeps busy
+        """
         self.f = f
+        self.version = version
+        self.memory = memory
+        self.threads = threads
+        self._fingerprint = None
 
     def __call__(self, *args, **kws):
         return Call(self, args, kws)
 
+    def map(self, items, *args, **kws):
+        """
+        Apply to each element of `items`, further arguments are passed to every call.
+        """
+        return MapCall(self, (items,) + args, kws)
+
+    def map_chunks(self, items, chunk_size, *args, **kws):
+        """
+        Apply to each chunk of `chunk_size` rows of the array `items`.
+        """
+        return MapCall(self, (items,) + args, kws, chunk_size=chunk_size)
+
     def __repr__(self):
         return self.f.__name__
 
+    def __reduce__(self):
+        # Pickle by reference like functions, `f` can't be pickled itself
+        # when its name refers to this operation (as with `@operation()`)
+        return _load_operation, (self.f.__module__, self.f.__qualname__, self.version, self.memory, self.threads)
+
     def cache_hash(self):
-        r = cache_hash(self.f.__code__.co_code)
-        return r
+        if self._fingerprint is None:
+            if self.version is not None:
+                self._fingerprint = cache_hash((self.f.__qualname__, self.version))
+            else:
+                self._fingerprint = code_fingerprint(self.f)
+        return self._fingerprint
 
     def compute(self, args_values, kws_values):
         return self.f(*args_values, **kws_values)
@@ -0,0 +1,183 @@
+
+import types
+import hashlib
+import logging
+import functools
+
+def code_fingerprint(f):
+    """
+    Hash of everything about function `f` that may influence its results:
+    bytecode, constants and names used (of nested functions too), default arguments,
+    values of closure variables and, recursively, the fingerprints of functions
+    from the same module that `f` references as globals.
+    Line numbers, local variable names and the docstring of `f` do not matter.
+    Values are encoded deterministically (the same in every process); values without such
+    an encoding (locks, random generators, loggers, ...) only contribute their type,
+    with a warning, give the operation a `version` if their state matters.
+
+    >>> def f(x, a=1): return x + a
+    >>> def g(x, a=1):
+    ...     # Same as f
+    ...     return x + a
+    >>> code_fingerprint(f) == code_fingerprint(g)
+    True
+    >>> def h(x, a=2): return x + a
+    >>> code_fingerprint(f) == code_fingerprint(h)
+    False
+    >>> def k(x, a=1): return x + 2 * a
+    >>> code_fingerprint(f) == code_fingerprint(k)
+    False
+    >>> def l(x, a=1):
+    ...     "Add a to x"
+    ...     return x + a
+    >>> code_fingerprint(f) == code_fingerprint(l)
+    True
+    >>> def m(x, a=1, b=2): return x + a * b
+    >>> def n(x, a=2, b=1): return x + a * b
+    >>> code_fingerprint(m) == code_fingerprint(n)
+    False
+
+    A closure over an object without encoding, like a lock:
+
+    >>> import threading
+    >>> def locked(lock):
+    ...     def o(x):
+    ...         with lock:
+    ...             return x
+    ...     return o
+    >>> code_fingerprint(locked(threading.Lock())) == code_fingerprint(locked(threading.Lock()))
+    True
+    """
+    h = hashlib.blake2b(digest_size=8)
+    seen = set()
+    _update_function(h, f, seen)
+    unencodable = sorted(x[1] for x in seen if isinstance(x, tuple))
+    if unencodable:
+        logging.warning("fingerprint of {} ignores the state of values of type {}".format(
+            f.__qualname__, ', '.join(unencodable)))
+    return int.from_bytes(h.digest(), 'big')
+
+def _update_function(h, f, seen):
+    if f.__code__ in seen:
+        # Recursion, the code is already part of the fingerprint
+        h.update(b'<recursion>' + f.__qualname__.encode())
+        return
+    seen.add(f.__code__)
+
+    _update_code(h, f.__code__, skip_doc=True)
+    h.update(b'<defaults>')
+    _update_value(h, f.__defaults__, seen)
+    _update_value(h, f.__kwdefaults__, seen)
+
+    h.update(b'<closure>')
+    for cell in f.__closure__ or ():
+        try:
+            _update_value(h, cell.cell_contents, seen)
+        except ValueError:
+            # Empty cell
+            h.update(b'<empty>')
+
+    h.update(b'<globals>')
+    for name in sorted(_global_names(f.__code__)):
+        v = f.__globals__.get(name)
+        if isinstance(v, types.FunctionType) and v.__module__ == f.__module__:
+            h.update(name.encode())
+            _update_function(h, v, seen)
+        elif hasattr(v, 'f') and isinstance(v.f, types.FunctionType) and hasattr(v, 'cache_hash'):
+            # Operation
+            h.update(name.encode())
+            h.update(repr(v.cache_hash()).encode())
+
+def _global_names(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= _global_names(c)
+    return names
+
+def _update_code(h, code, skip_doc=False):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    consts = code.co_consts
+    if skip_doc and consts and (consts[0] is None or isinstance(consts[0], str)):
+        # The docstring (None if there is none) is stored as first constant
+        consts = consts[1:]
+    h.update(b'<consts>')
+    for c in consts:
+        if isinstance(c, types.CodeType):
+            h.update(b'<code>')
+            _update_code(h, c)
+        else:
+            _update_value(h, c, set())
+
+def _digest(v, seen):
+    h = hashlib.blake2b(digest_size=16)
+    _update_value(h, v, seen)
+    return h.digest()
+
+def _tag(h, name, *parts):
+    h.update('<{}{}>'.format(name, ''.join(' {!r}'.format(p) for p in parts)).encode())
+
+def _update_value(h, v, seen):
+    """
+    Feed a deterministic encoding of `v` into `h`: Order matters for sequences,
+    not for sets and dicts, objects are encoded by class and attributes.
+    """
+    if isinstance(v, types.FunctionType):
+        _tag(h, 'function')
+        _update_function(h, v, seen)
+    elif hasattr(v, 'f') and isinstance(v.f, types.FunctionType) and hasattr(v, 'cache_hash'):
+        # Operation
+        _tag(h, 'operation', v.cache_hash())
+    elif v is None or v is Ellipsis or isinstance(v, (bool, int, float, complex)):
+        # repr() of these is the same in every process
+        _tag(h, type(v).__name__, v)
+    elif isinstance(v, (str, bytes, bytearray)):
+        data = v.encode() if isinstance(v, str) else bytes(v)
+        _tag(h, type(v).__name__, len(data))
+        h.update(data)
+    elif isinstance(v, (tuple, list)):
+        _tag(h, type(v).__name__, len(v))
+        for x in v:
+            _update_value(h, x, seen)
+    elif isinstance(v, (set, frozenset)):
+        _tag(h, type(v).__name__, len(v))
+        for d in sorted(_digest(x, seen) for x in v):
+            h.update(d)
+    elif isinstance(v, dict):
+        _tag(h, 'dict', len(v))
+        for k, x in sorted((_digest(k, seen), _digest(x, seen)) for k, x in v.items()):
+            h.update(k + x)
+    elif isinstance(v, (type, types.BuiltinFunctionType)):
+        _tag(h, 'global', v.__module__, v.__qualname__)
+    elif isinstance(v, types.ModuleType):
+        _tag(h, 'module', v.__name__)
+    elif isinstance(v, functools.partial):
+        _tag(h, 'partial')
+        _update_value(h, (v.func, v.args, v.keywords), seen)
+    elif hasattr(v, 'dtype') and hasattr(v, 'shape') and hasattr(v, 'tobytes'):
+        # numpy array
+        _tag(h, 'array', str(v.dtype), tuple(v.shape))
+        h.update(v.tobytes())
+    elif callable(getattr(v, 'cache_hash', None)):
+        _tag(h, 'cache_hash', type(v).__module__, type(v).__qualname__, v.cache_hash())
+    elif hasattr(v, '__dict__') or hasattr(type(v), '__slots__'):
+        if id(v) in seen:
+            _tag(h, 'recursion')
+            return
+        seen.add(id(v))
+        attributes = dict(getattr(v, '__dict__', {}))
+        for cls in type(v).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if name not in ('__dict__', '__weakref__') and hasattr(v, name):
+                    attributes[name] = getattr(v, name)
+        _tag(h, 'object', type(v).__module__, type(v).__qualname__)
+        _update_value(h, attributes, seen)
+    else:
+        # No deterministic encoding (e.g. a lock), only the type can be part of the fingerprint.
+        # Recorded in `seen` for code_fingerprint() to warn about.
+        name = '{}.{}'.format(type(v).__module__, type(v).__qualname__)
+        seen.add(('unencodable', name))
+        _tag(h, 'unencodable', name)
+
@@ -0,0 +1,58 @@
+
+from collections import namedtuple
+
+GarbageReport = namedtuple('GarbageReport', ('deleted', 'kept', 'nbytes'))
+
+def reachable_keys(storage, roots=(), sessions=None):
+    """
+    Keys of all stored entries needed by the call graphs `roots`
+    and by the last `sessions` recorded sessions.
+    """
+    from .session import Session
+
+    keys = set()
+    if sessions is not None:
+        keys.update(storage.session_keys(sessions))
+
+    session = Session(storage)
+    for root in roots:
+        for node in session.plan(root, estimate=False).nodes:
+            if node.key is not None:
+                keys.add(node.key)
+            keys.update(node.elements)
+    return keys
+
+def collect_garbage(storage, roots=(), sessions=None, dry_run=False):
+    """
+    Delete all entries from `storage` that are not reachable from the call graphs
+    `roots` or used by the last `sessions` recorded sessions (see `Session.compute()`).
+    Records of older sessions are forgotten.
+
+    At least one of `roots` and `sessions` must be given, so that a forgotten argument
+    does not empty the storage (to really delete everything, pass `sessions=0`).
+
+    dry_run: Only report what would be deleted.
+
+    Returns a `GarbageReport` with the deleted keys, the number of kept keys
+    and the number of bytes reclaimed.
+    """
+    roots = list(roots)
+    if not roots and sessions is None:
+        raise ValueError('collect_garbage() needs roots or sessions to keep, refusing to delete everything')
+
+    reachable = reachable_keys(storage, roots, sessions)
+    sizes = storage.sizes()
+    deleted = [key for key in sizes if key not in reachable]
+
+    if not dry_run:
+        for key in deleted:
+            storage.delete(key)
+        if sessions is not None:
+            storage.forget_sessions(sessions)
+
+    return GarbageReport(
+        deleted=deleted,
+        kept=len(sizes) - len(deleted),
+        nbytes=sum(sizes[key] for key in deleted)
+    )
+
@@ -0,0 +1,505 @@
+
+import os
+import hmac
+import time
+import queue
+import pickle
+import hashlib
+import threading
+import http.client
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, quote, unquote, parse_qs
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+def _strip_namespace(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _find_all(element, tag):
+    return [e for e in element.iter() if _strip_namespace(e.tag) == tag]
+
+def _find_text(element, tag, default=None):
+    found = _find_all(element, tag)
+    return found[0].text if found else default
+
+class ObjectStorage:
+    """
+    Pipeline storage in an S3 compatible object store (path-style addressing).
+
+    Each entry is stored as two objects, `<prefix><key>/value` (the pickled value)
+    and `<prefix><key>/meta` (hash, metadata and size). The meta object is written
+    last, so an entry is visible only once complete. Values larger than `part_size`
+    are uploaded and downloaded in parts in parallel. Connections are kept alive
+    and reused, metadata of entries is cached locally (entries never change,
+    but deletions by other processes are not noticed).
+
+    >>> from .pipeline import operation
+    >>> from .session import Session
+    >>> @operation()
+    ... def numbers(n):
+    ...     return list(range(n))
+    >>> with LocalObjectStore() as server:
+    ...     storage = ObjectStorage(server.endpoint, 'bucket', part_size=100)
+    ...     r = Session(storage).compute(numbers(1000)).load_value()
+    ...     # Another process, metadata and value come from the server
+    ...     other = ObjectStorage(server.endpoint, 'bucket')
+    ...     r2 = Session(other).compute(numbers(1000)).load_value()
+    ...     n = len(other.keys())
+    >>> r == r2 == list(range(1000)), n
+    (True, 1)
+    """
+
+    def __init__(self, endpoint, bucket, prefix='', access_key=None, secret_key=None,
+            region='us-east-1', pool_size=8, part_size=8 << 20, cache_dir=None, timeout=60):
+        """
+        endpoint:   URL of the object store, eg. 'http://localhost:9000'
+        bucket:     Bucket to store in (must exist)
+        prefix:     Prefix for all object names
+        access_key,
+        secret_key: Credentials, requests are signed (AWS signature version 4) if given
+        pool_size:  Number of connections to keep alive and of parallel part transfers
+        part_size:  Values larger than this are transferred in parts of this size
+        cache_dir:  Directory to cache entry metadata in across processes
+                    (in addition to in memory)
+        """
+        url = urlsplit(endpoint)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.bucket = bucket
+        self.prefix = prefix
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.pool_size = pool_size
+        self.part_size = part_size
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._executor = ThreadPoolExecutor(pool_size)
+        # key -> {'hash': .., 'meta': .., 'size': ..}
+        self._entries = {}
+
+    # HTTP
+
+    def _connect(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            if self.scheme == 'https':
+                return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+            return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _request(self, method, name=None, query={}, body=b'', headers={}):
+        """
+        Request on object `name` (on the bucket if None), returns (status, headers, body).
+        Raises KeyError if the object does not exist.
+        """
+        path = '/' + quote(self.bucket) + ('' if name is None else '/' + quote(name, safe='/~'))
+        query_string = '&'.join(
+            '{}={}'.format(quote(k, safe='~'), quote(v, safe='~')) for k, v in sorted(query.items())
+        )
+        headers = dict(headers, Host=self.host)
+        if self.access_key is not None:
+            self._sign(method, path, query_string, headers)
+
+        # A kept-alive connection may have been closed by the server, retry once
+        for attempt in range(2):
+            connection = self._connect()
+            try:
+                connection.request(method, path + ('?' + query_string if query_string else ''),
+                        body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        if response.status == 404:
+            raise KeyError(name)
+        if response.status >= 300:
+            raise IOError('{} {}: {} {}'.format(method, path, response.status, data[:200]))
+        return response.status, response.headers, data
+
+    def _sign(self, method, path, query_string, headers):
+        """
+        Add AWS signature version 4 headers (with unsigned payload).
+        """
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+
+        lower = {k.lower(): str(v).strip() for k, v in headers.items()}
+        signed_headers = ';'.join(sorted(lower))
+        canonical_request = '\n'.join((
+            method, path, query_string,
+            ''.join('{}:{}\n'.format(k, lower[k]) for k in sorted(lower)),
+            signed_headers, 'UNSIGNED-PAYLOAD'
+        ))
+        scope = '{}/{}/s3/aws4_request'.format(date, self.region)
+        string_to_sign = '\n'.join((
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest()
+        ))
+
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            self.access_key, scope, signed_headers, signature
+        )
+
+    def _list(self, prefix):
+        """
+        Yield (name, size) of all objects starting with `prefix`.
+        """
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if token is not None:
+                query['continuation-token'] = token
+            _, _, data = self._request('GET', query=query)
+            root = ET.fromstring(data)
+            for contents in _find_all(root, 'Contents'):
+                yield _find_text(contents, 'Key'), int(_find_text(contents, 'Size'))
+            if _find_text(root, 'IsTruncated') != 'true':
+                break
+            token = _find_text(root, 'NextContinuationToken')
+
+    def _put(self, name, data):
+        if len(data) <= self.part_size:
+            self._request('PUT', name, body=data)
+            return
+
+        _, _, response = self._request('POST', name, query={'uploads': ''})
+        upload_id = _find_text(ET.fromstring(response), 'UploadId')
+
+        def put_part(i):
+            _, headers, _ = self._request(
+                'PUT', name, query={'partNumber': str(i + 1), 'uploadId': upload_id},
+                body=data[i * self.part_size:(i + 1) * self.part_size]
+            )
+            return headers.get('ETag', '')
+
+        n = (len(data) + self.part_size - 1) // self.part_size
+        etags = list(self._executor.map(put_part, range(n)))
+        self._request('POST', name, query={'uploadId': upload_id}, body=(
+            '<CompleteMultipartUpload>' + ''.join(
+                '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(i + 1, escape(etag))
+                for i, etag in enumerate(etags)
+            ) + '</CompleteMultipartUpload>'
+        ).encode())
+
+    def _get(self, name, size):
+        if size <= self.part_size:
+            return self._request('GET', name)[2]
+
+        def get_part(offset):
+            end = min(offset + self.part_size, size) - 1
+            return self._request('GET', name, headers={'Range': 'bytes={}-{}'.format(offset, end)})[2]
+
+        return b''.join(self._executor.map(get_part, range(0, size, self.part_size)))
+
+    # Entries
+
+    def _name(self, key, kind):
+        return '{}{}/{}'.format(self.prefix, hex(key), kind)
+
+    def _get_cache_filename(self, key):
+        return self.cache_dir + '/' + hex(key) + '.meta'
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+
+        if self.cache_dir is not None:
+            try:
+                with open(self._get_cache_filename(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except FileNotFoundError:
+                pass
+
+        if entry is None:
+            entry = pickle.loads(self._request('GET', self._name(key, 'meta'))[2])
+            if self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                filename = self._get_cache_filename(key)
+                with open('{}.{}.tmp'.format(filename, os.getpid()), 'wb') as f:
+                    pickle.dump(entry, f)
+                os.replace('{}.{}.tmp'.format(filename, os.getpid()), filename)
+
+        self._entries[key] = entry
+        return entry
+
+    def load(self, key):
+        from .calltree import Value
+
+        entry = self._entry(key)
+        return Value(
+            hash_=entry['hash'],
+            loader=lambda: pickle.loads(self._get(self._name(key, 'value'), entry['size']))
+        )
+
+    def save(self, key, value, meta={}):
+        data = pickle.dumps(value.load_value(), protocol=5)
+        self._put(self._name(key, 'value'), data)
+
+        meta = dict(meta)
+        meta['value_size'] = len(data)
+        entry = {'hash': value.get_hash(), 'meta': meta, 'size': len(data)}
+        # Publish
+        self._request('PUT', self._name(key, 'meta'), body=pickle.dumps(entry))
+        self._entries[key] = entry
+        return len(data)
+
+    def get_meta(self, key):
+        return self._entry(key)['meta']
+
+    def keys(self):
+        return [
+            int(name[len(self.prefix):].split('/')[0], 16)
+            for name, _ in self._list(self.prefix)
+            if name.endswith('/meta') and not name.startswith(self.prefix + 'sessions/')
+        ]
+
+    def iter_meta(self):
+        def get_meta(key):
+            try:
+                return self.get_meta(key)
+            except KeyError:
+                # Deleted in the meantime
+                return None
+        for meta in self._executor.map(get_meta, self.keys()):
+            if meta is not None:
+                yield meta
+
+    def sizes(self):
+        return {
+            int(name[len(self.prefix):].split('/')[0], 16): size
+            for name, size in self._list(self.prefix)
+            if name.endswith('/value')
+        }
+
+    def delete(self, key):
+        # Meta first, so the entry disappears before its value does
+        for kind in ('meta', 'value'):
+            try:
+                self._request('DELETE', self._name(key, kind))
+            except KeyError:
+                pass
+        self._entries.pop(key, None)
+        if self.cache_dir is not None:
+            try:
+                os.remove(self._get_cache_filename(key))
+            except FileNotFoundError:
+                pass
+
+    def record_session(self, session, keys):
+        name = '{}sessions/{}'.format(self.prefix, session)
+        try:
+            keys = set(keys) | pickle.loads(self._request('GET', name)[2])['keys']
+        except KeyError:
+            pass
+        self._request('PUT', name, body=pickle.dumps({'time': time.time(), 'keys': set(keys)}))
+
+    def _sessions(self):
+        """
+        Recorded sessions, most recent first.
+        """
+        sessions = [
+            (name, pickle.loads(self._request('GET', name)[2]))
+            for name, _ in self._list(self.prefix + 'sessions/')
+        ]
+        sessions.sort(key=lambda s: -s[1]['time'])
+        return sessions
+
+    def session_keys(self, n):
+        keys = set()
+        for _, session in self._sessions()[:n]:
+            keys |= session['keys']
+        return keys
+
+    def forget_sessions(self, keep):
+        for name, _ in self._sessions()[keep:]:
+            self._request('DELETE', name)
+
+class LocalObjectStore:
+    """
+    In-process stand-in for an S3 compatible object store for testing `ObjectStorage`:
+    Path-style addressing, keeps objects in memory and supports put, get (with ranges),
+    head, delete, listing (v2) and multipart uploads. Buckets are created implicitly,
+    credentials are not checked.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        # (bucket, name) -> bytes
+        self.objects = {}
+        # upload id -> {part number: bytes}
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+        store = self
+        class Handler(_LocalObjectStoreHandler):
+            pass
+        Handler.store = store
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.endpoint = 'http://{}:{}'.format(*self.server.server_address[:2])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _LocalObjectStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlsplit(self.path)
+        bucket, _, name = url.path.lstrip('/').partition('/')
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        return unquote(bucket), unquote(name), query
+
+    def _respond(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, tag, content):
+        return '<?xml version="1.0" encoding="UTF-8"?><{0} xmlns="{1}">{2}</{0}>'.format(
+            tag, S3_NAMESPACE, content
+        ).encode()
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        bucket, name, query = self._parse()
+        if not name:
+            return self._list(bucket, query)
+
+        data = self.store.objects.get((bucket, name))
+        if data is None:
+            return self._respond(404)
+
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return self._respond(200, data)
+        start, end = byte_range.split('=')[1].split('-')
+        end = min(int(end), len(data) - 1)
+        self._respond(206, data[int(start):end + 1], {
+            'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))
+        })
+
+    def do_HEAD(self):
+        bucket, name, _ = self._parse()
+        data = self.store.objects.get((bucket, name))
+        if data is None:
+            return self._respond(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        start = query.get('continuation-token', '')
+        max_keys = int(query.get('max-keys', 1000))
+        with self.store._lock:
+            names = sorted(
+                (name, len(data)) for (b, name), data in self.store.objects.items()
+                if b == bucket and name.startswith(prefix) and name > start
+            )
+        truncated = len(names) > max_keys
+        names = names[:max_keys]
+
+        content = ''.join(
+            '<Contents><Key>{}</Key><Size>{}</Size></Contents>'.format(escape(name), size)
+            for name, size in names
+        )
+        content += '<IsTruncated>{}</IsTruncated>'.format('true' if truncated else 'false')
+        if truncated:
+            content += '<NextContinuationToken>{}</NextContinuationToken>'.format(escape(names[-1][0]))
+        self._respond(200, self._xml('ListBucketResult', content))
+
+    def do_PUT(self):
+        bucket, name, query = self._parse()
+        data = self._body()
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        with self.store._lock:
+            if 'uploadId' in query:
+                if query['uploadId'] not in self.store.uploads:
+                    return self._respond(404)
+                self.store.uploads[query['uploadId']][int(query['partNumber'])] = data
+            else:
+                self.store.objects[bucket, name] = data
+        self._respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, name, query = self._parse()
+        body = self._body()
+        with self.store._lock:
+            if 'uploads' in query:
+                upload_id = os.urandom(8).hex()
+                self.store.uploads[upload_id] = {}
+                return self._respond(200, self._xml(
+                    'InitiateMultipartUploadResult',
+                    '<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'.format(
+                        escape(bucket), escape(name), upload_id
+                    )
+                ))
+
+            parts = self.store.uploads.pop(query.get('uploadId'), None)
+            if parts is None:
+                return self._respond(404)
+            numbers = [int(e.text) for e in _find_all(ET.fromstring(body), 'PartNumber')]
+            self.store.objects[bucket, name] = b''.join(parts[n] for n in numbers)
+        self._respond(200, self._xml(
+            'CompleteMultipartUploadResult',
+            '<Bucket>{}</Bucket><Key>{}</Key>'.format(escape(bucket), escape(name))
+        ))
+
+    def do_DELETE(self):
+        bucket, name, _ = self._parse()
+        with self.store._lock:
+            self.store.objects.pop((bucket, name), None)
+        self._respond(204)
+
@@ -1,14 +1,18 @@
 
 from .calltree import Operation
 
-def operation():
+def operation(version=None, memory=None, threads=1):
     def wrapper(f):
-        return Operation(f)
+        return Operation(f, version=version, memory=memory, threads=threads)
     return wrapper
 
 
-def demo():
+def demo(base_dir=None):
+    """
+    base_dir: Where to cache, a temporary directory (removed afterwards) if None
+    """
 
+    import tempfile
     import numpy as np
     from .storage import DiskStorage
     from .session import Session
@@ -30,21 +34,47 @@ def demo():
     b = foo(a)
     c = bar(b)
 
-    s = Session(storage=DiskStorage('_cache_test'))
-    print('compute=',s.compute(c).load_value())
-    print('compute=',s.compute(c).load_value())
+    with tempfile.TemporaryDirectory() as tmp:
+        s = Session(storage=DiskStorage(base_dir or tmp))
+        print('compute=',s.compute(c).load_value())
+        print('compute=',s.compute(c).load_value())
 
 
-def print_cachefile(filename):
+def print_meta(base_dir, key=None):
     from pprint import pprint
     from .storage import DiskStorage
 
-    pprint(DiskStorage.load_meta(filename))
+    storage = DiskStorage(base_dir)
+    if key is None:
+        for meta in storage.iter_meta():
+            pprint(meta)
+    else:
+        pprint(storage.get_meta(int(key, 16)))
+
+def gc(base_dir, sessions, dry_run=False, force=False):
+    from .storage import DiskStorage
+    from .garbage import collect_garbage
+
+    sessions = int(sessions)
+    if sessions <= 0 and not (dry_run or force):
+        # Keeping no sessions deletes everything
+        raise SystemExit('gc: keeping {} sessions would delete all entries, use --dry-run or --force'.format(sessions))
+
+    report = collect_garbage(DiskStorage(base_dir), sessions=sessions, dry_run=dry_run)
+    print('{} {} entries ({} bytes), kept {}'.format(
+        'would delete' if dry_run else 'deleted', len(report.deleted), report.nbytes, report.kept
+    ))
 
 if __name__ == '__main__':
     import sys
 
     if len(sys.argv) < 2:
         demo()
+    elif sys.argv[1] == 'demo':
+        # demo [<base_dir>]
+        demo(*sys.argv[2:3])
+    elif sys.argv[1] == 'gc':
+        # gc <base_dir> <keep last n sessions> [--dry-run] [--force]
+        gc(sys.argv[2], sys.argv[3], dry_run='--dry-run' in sys.argv[4:], force='--force' in sys.argv[4:])
     else:
-        print_cachefile(sys.argv[1])
+        print_meta(*sys.argv[1:3])
@@ -0,0 +1,65 @@
+
+from collections import namedtuple
+
+from text import format_table
+
+CACHED = 'cached'
+MISSING = 'missing'
+# Key can not be determined yet because some input still has to be computed
+PENDING = 'pending'
+
+# `elements` are the keys of the elements of mapped operations
+PlanNode = namedtuple(
+    'PlanNode', ('call', 'key', 'status', 'size', 'runtime', 'inputs', 'elements'),
+    defaults=((),)
+)
+
+class Plan:
+    """
+    Result of `Session.plan()`: The nodes of a call graph (in topological order)
+    with their storage status.
+
+    For cached nodes `size` and `runtime` are the stored value size and the
+    recorded computation time, for nodes that will run `runtime` is the average
+    of previously recorded runtimes of the same function (None if unknown).
+    """
+    def __init__(self, nodes):
+        self.nodes = tuple(nodes)
+
+    @property
+    def root(self):
+        return self.nodes[-1]
+
+    @property
+    def to_run(self):
+        return tuple(n for n in self.nodes if n.status != CACHED)
+
+    @property
+    def to_load(self):
+        """
+        Cached nodes whose values will actually be loaded, ie. that feed a node
+        that will run (or are the root). All other cached intermediates are skipped.
+        """
+        needed = set(id(i) for n in self.to_run for i in n.inputs)
+        needed.add(id(self.root))
+        return tuple(n for n in self.nodes if n.status == CACHED and id(n) in needed)
+
+    @property
+    def estimated_time(self):
+        return sum(n.runtime for n in self.to_run if n.runtime is not None)
+
+    def __str__(self):
+        return format_table(
+            [
+                (
+                    n.call.operation, 'n/a' if n.key is None else hex(abs(n.key)), n.status,
+                    '' if n.size is None else n.size,
+                    '?' if n.runtime is None else '{:.3f}'.format(n.runtime),
+                )
+                for n in self.nodes
+            ],
+            ('operation', 'key', 'status', 'size', 'runtime')
+        ) + 'estimated time: {:.3f}s ({} of {} nodes to run)\n'.format(
+            self.estimated_time, len(self.to_run), len(self.nodes)
+        )
+
@@ -0,0 +1,85 @@
+
+import os
+import threading
+from contextlib import contextmanager
+
+from osutil import free_ram
+
+class MemoryScheduler:
+    """
+    Admission control for operations running in parallel (see `Session`):
+    An operation is started only while the available RAM minus the memory reserved
+    by the running operations stays above `margin` bytes, and the number of
+    threads they declared stays within `max_threads`.
+    An operation is always admitted if nothing else is running, so operations
+    that need more than the machine has still make progress (one at a time).
+
+    When memory is short, the callbacks in `on_pressure` are called with the
+    number of bytes missing, so cached values can be dropped (eg. `TieredStorage.evict()`).
+
+    >>> s = MemoryScheduler(margin=100, max_threads=4, free_ram=lambda: 1000)
+    >>> with s.reserve(500):
+    ...     s.admissible(300), s.admissible(500), s.admissible(100, threads=4)
+    (True, False, False)
+    """
+
+    def __init__(self, margin=1 << 30, max_threads=None, free_ram=free_ram, poll_interval=.5):
+        """
+        margin:        Bytes of RAM to keep available
+        max_threads:   Maximum number of threads of concurrently running operations,
+                       defaults to the number of CPUs
+        free_ram:      Function returning the available RAM in bytes
+        poll_interval: Seconds between re-checks of available RAM while waiting
+        """
+        self.margin = margin
+        self.max_threads = max_threads or os.cpu_count()
+        self.free_ram = free_ram
+        self.poll_interval = poll_interval
+        self.on_pressure = []
+
+        self.reserved = 0
+        self.threads = 0
+        self.running = 0
+        self._condition = threading.Condition()
+
+    def _shortage(self, memory):
+        return self.margin + self.reserved + memory - self.free_ram()
+
+    def admissible(self, memory, threads=1):
+        """
+        Whether an operation needing `memory` bytes and `threads` threads could start now.
+        """
+        if not self.running:
+            return True
+        return self._shortage(memory) <= 0 and self.threads + threads <= self.max_threads
+
+    @contextmanager
+    def reserve(self, memory, threads=1):
+        """
+        Block until an operation needing `memory` bytes and `threads` threads
+        is admitted, keep the reservation for the duration of the with block.
+        """
+        with self._condition:
+            while True:
+                shortage = self._shortage(memory)
+                if shortage > 0:
+                    for f in self.on_pressure:
+                        f(shortage)
+                if self.admissible(memory, threads):
+                    break
+                # Also wake up from time to time, RAM is freed by others too
+                self._condition.wait(self.poll_interval)
+
+            self.reserved += memory
+            self.threads += threads
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= memory
+                self.threads -= threads
+                self.running -= 1
+                self._condition.notify_all()
+
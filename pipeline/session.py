@@ -1,30 +1,634 @@
 
+import os
+import time
+import uuid
+import asyncio
+import inspect
+import threading
+import functools
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
 from hashing import cache_hash
+from osutil import rss
+
+class _Measurement:
+    __slots__ = ('start', 'peak', 'tracing', 'alone')
+
+class _MemorySampler:
+    """
+    Peak memory growth of the operations computed in this process in bytes (None if unknown).
+    Measured with `tracemalloc` if it is tracing, otherwise by one thread shared by all
+    measurements that samples the resident memory (RSS) every `interval` seconds while any
+    are running. Unlike the maximum RSS of the process, this is not hidden by earlier peaks.
+    Memory is process-wide, so operations that overlapped (eg. in a thread executor)
+    are not measured rather than charged with each other's memory.
+    """
+
+    def __init__(self, interval=.001):
+        self.interval = interval
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    def start(self):
+        m = _Measurement()
+        m.tracing = tracemalloc.is_tracing()
+        with self._lock:
+            m.alone = not self._running
+            for other in self._running:
+                other.alone = False
+            if m.tracing:
+                if m.alone:
+                    tracemalloc.reset_peak()
+                m.start = m.peak = tracemalloc.get_traced_memory()[0]
+            else:
+                m.start = m.peak = rss()
+                if m.start is not None and self._thread is None:
+                    self._thread = threading.Thread(target=self._sample, name='MemorySampler', daemon=True)
+                    self._thread.start()
+            self._running.add(m)
+            self._wake.notify()
+        return m
+
+    def stop(self, m):
+        with self._lock:
+            self._running.discard(m)
+        if not m.alone or m.start is None:
+            return None
+        if m.tracing:
+            return tracemalloc.get_traced_memory()[1] - m.start
+        return max(m.peak, rss()) - m.start
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                while not self._running:
+                    self._wake.wait()
+            time.sleep(self.interval)
+            current = rss()
+            with self._lock:
+                for m in self._running:
+                    if not m.tracing and m.start is not None:
+                        m.peak = max(m.peak, current)
+
+_sampler = _MemorySampler()
+
+def _reset_sampler():
+    # The sampling thread does not survive a fork
+    global _sampler
+    _sampler = _MemorySampler()
+
+os.register_at_fork(after_in_child=_reset_sampler)
+
+def _timed_compute(execution):
+    """
+    Compute `execution`, return the result and a dict of timings (see `RunTrace.add()`).
+    The peak memory growth is measured by the shared `_MemorySampler`.
+    """
+    from .calltree import Value
+
+    measurement = _sampler.start()
+    try:
+        start = time.perf_counter()
+        args, kws = execution.load_inputs()
+        t = time.perf_counter()
+        result = Value(value=execution.call.operation.compute(args, kws))
+        end = time.perf_counter()
+    finally:
+        memory = _sampler.stop(measurement)
+
+    return result, {
+        'start': start,
+        'load': t - start,
+        'compute': end - t,
+        'thread': threading.get_ident(),
+        'memory': memory,
+    }
 
 class Session:
-    def __init__(self, storage):
+    def __init__(self, storage, memoize=True, executor=None, scheduler=None):
+        """
+        storage:  Storage for intermediate results (eg. `DiskStorage`)
+        memoize:  If True, results are remembered by key for the lifetime of the
+                  session, otherwise only for the duration of a single `compute()`.
+                  Either way, a node that occurs several times in a call tree is
+                  resolved only once.
+        executor: Optional `concurrent.futures.Executor` to compute the missing
+                  elements of mapped operations (`Operation.map()`) in parallel.
+                  For process pools, the inputs must be picklable and operations
+                  defined at module level (they are pickled by name, like functions).
+        scheduler: Optional `MemoryScheduler` that admits operations (from any thread)
+                  only while there is enough memory. Operations reserve the memory
+                  they declare (`operation(memory=...)`), or else the most they used
+                  in previous runs. Under memory pressure the session forgets values
+                  it memoized and asks the storage to `evict()` (if supported).
+                  Requires a thread based executor.
+
+        Every node resolved is recorded in `trace` (a `RunTrace`).
+        """
+        from .trace import RunTrace
+
         self.storage = storage
+        self.memoize = memoize
+        self.executor = executor
+        self.scheduler = scheduler
+        self.trace = RunTrace()
+        self._results = {}
+        # Most memory used by each function in previous runs, read on first use
+        self._memory_history = None
+        if scheduler is not None:
+            scheduler.on_pressure.append(self._relieve)
+        self._shared = False
+        self.id = uuid.uuid4().hex
+        # Keys used by the current `compute()`, recorded in the storage (if supported)
+        # so garbage collection can keep what recent sessions needed
+        self._used = set()
 
     def compute(self, call):
-        from .calltree import Call, Value, CallExecution
+        if not self.memoize:
+            self._results = {}
+        # Results by id() of the nodes of this tree, so repeated occurrences of the
+        # same object don't even need to be hashed again
+        result = self._compute(call, {})
+        self._record_used()
+        return result
+
+    def compute_shared(self, call, poll_interval=1.):
+        """
+        Compute `call` together with other processes (possibly on other machines)
+        working on the same graph against the same storage directory.
+
+        Each missing node is claimed through the storage (see `DiskStorage.claim()`)
+        before it is computed. Nodes claimed by other processes are skipped (along
+        with everything depending on them) and the graph is revisited every
+        `poll_interval` seconds until the result is available.
+        """
+        self._shared = True
+        try:
+            while True:
+                if not self.memoize:
+                    self._results = {}
+                result = self._compute(call, {})
+                if result is not None:
+                    return result
+                time.sleep(poll_interval)
+        finally:
+            self._shared = False
+            self._record_used()
+
+    def _record_used(self):
+        if self._used and hasattr(self.storage, 'record_session'):
+            self.storage.record_session(self.id, self._used)
+        self._used = set()
+
+    def _compute(self, call, seen):
+        from .calltree import Call, MapCall, Value, CallExecution
+
+        if id(call) in seen:
+            return seen[id(call)]
 
         if not isinstance(call, Call):
             # Not a call but a constant, just return it wrapped in a value
-            return Value(value=call)
+            result = call if isinstance(call, Value) else Value(value=call)
+            seen[id(call)] = result
+            return result
 
         # args/kws contain CallExecutions
-        args = [self.compute(a) for a in call.args]
-        kws = {k: self.compute(v) for k, v in call.kws.items()}
+        args = [self._compute(a, seen) for a in call.args]
+        kws = {k: self._compute(v, seen) for k, v in call.kws.items()}
 
-        execution = CallExecution(call, args=args, kws=kws)
-        key = cache_hash(execution)
+        if any(v is None for v in args + list(kws.values())):
+            # Some input is being computed by another process (see `compute_shared()`)
+            result = None
+        elif isinstance(call, MapCall):
+            result = self._compute_map(call, args, kws)
+        else:
+            execution = CallExecution(call, args=args, kws=kws)
+            key = cache_hash(execution)
+            result = self._traced_lookup(key, call)
+            if result is None:
+                result = self._compute_missing([key], [execution])[0]
 
-        try:
-            result = self.storage.load(key)
-        except KeyError:
-            result = execution.compute()
-            self.storage.save(key, result, meta=execution.get_metadata(args, kws))
+        seen[id(call)] = result
+        return result
+
+    def _lookup(self, key):
+        """
+        Result for `key` from this session or storage, None if not available.
+        """
+        result = self._results.get(key)
+        if result is None:
+            try:
+                result = self.storage.load(key)
+            except KeyError:
+                return None
+            self._results[key] = result
+        self._used.add(key)
+        return result
+
+    def _traced_lookup(self, key, call):
+        from .trace import MEMO, HIT
+
+        status = MEMO if key in self._results else HIT
+        start = time.perf_counter()
+        result = self._lookup(key)
+        if result is not None:
+            self.trace.add(call, key, status, start=start, load=time.perf_counter() - start)
+        return result
 
+    def _save(self, key, execution, result, timing):
+        from .trace import MISS
+
+        meta = execution.get_metadata(execution.args, execution.kws)
+        meta['runtime'] = timing['compute']
+        meta['memory'] = timing['memory']
+        if self._memory_history is not None and timing['memory'] is not None:
+            f = meta['function']
+            self._memory_history[f] = max(self._memory_history.get(f, 0), timing['memory'])
+
+        start = time.perf_counter()
+        nbytes = self.storage.save(key, result, meta=meta)
+        self.trace.add(execution.call, key, MISS, save_start=start, save=time.perf_counter() - start,
+                nbytes=nbytes, **timing)
+
+        self._results[key] = result
+        self._used.add(key)
         return result
 
+    def _map_executions(self, call, args, kws):
+        from .calltree import Value, CallExecution
+
+        return [
+            CallExecution(
+                call,
+                args=[element if isinstance(element, Value) else Value(value=element)] + args[1:],
+                kws=kws
+            )
+            for element in call.split(args[0].load_value())
+        ]
+
+    def _join(self, call, results):
+        """
+        Lazily joined value of the element results of a mapped call.
+        """
+        from .calltree import Value
+
+        return Value(
+            hash_=cache_hash([r.get_hash() for r in results]),
+            loader=lambda: call.join([r.load_value() for r in results])
+        )
+
+    def _compute_map(self, call, args, kws):
+        executions = self._map_executions(call, args, kws)
+        keys = [cache_hash(e) for e in executions]
+        results = [self._traced_lookup(key, call) for key in keys]
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        computed = self._compute_missing([keys[i] for i in missing], [executions[i] for i in missing])
+        for i, result in zip(missing, computed):
+            results[i] = result
+
+        if None in results:
+            return None
+        return self._join(call, results)
+
+    def _compute_missing(self, keys, executions):
+        """
+        Compute and save the results for `keys`, using the executor if there is one.
+        When computing shared, only keys that can be claimed are computed,
+        the results for the others are None.
+        """
+        if self._shared and self.executor is None and len(keys) > 1:
+            # Claim one at a time so other processes can take the remaining ones
+            return [self._compute_missing([k], [e])[0] for k, e in zip(keys, executions)]
+
+        results = [None] * len(keys)
+        todo = list(range(len(keys)))
+        if self._shared:
+            todo = [i for i in todo if self.storage.claim(keys[i])]
+        claimed = [keys[i] for i in todo] if self._shared else []
+
+        try:
+            if self._shared:
+                # Might have been published between lookup and claim
+                for i in todo:
+                    results[i] = self._lookup(keys[i])
+                todo = [i for i in todo if results[i] is None]
+
+            with self._heartbeat([keys[i] for i in todo]):
+                # Keep the executor's function picklable unless scheduling is needed
+                f = _timed_compute if self.scheduler is None else self._scheduled_compute
+                if self.executor is None:
+                    computed = (f(executions[i]) for i in todo)
+                else:
+                    computed = self.executor.map(f, [executions[i] for i in todo])
+
+                for i, (result, timing) in zip(todo, computed):
+                    results[i] = self._save(keys[i], executions[i], result, timing)
+
+        finally:
+            for key in claimed:
+                self.storage.release(key)
+
+        return results
+
+    def _scheduled_compute(self, execution):
+        if self.scheduler is None:
+            return _timed_compute(execution)
+        operation = execution.call.operation
+        with self.scheduler.reserve(self._memory_estimate(operation), operation.threads):
+            return _timed_compute(execution)
+
+    def _memory_estimate(self, operation):
+        if operation.memory is not None:
+            return operation.memory
+        if self._memory_history is None:
+            history = {}
+            for meta in self.storage.iter_meta():
+                if meta.get('memory') is not None:
+                    f = meta['function']
+                    history[f] = max(history.get(f, 0), meta['memory'])
+            self._memory_history = history
+        return self._memory_history.get(operation.f.__qualname__, 0)
+
+    def _relieve(self, nbytes):
+        """
+        Called by the scheduler under memory pressure: Forget memoized values
+        (they are all in the storage) and let the storage evict what it keeps in memory.
+        """
+        self._results = {}
+        evict = getattr(self.storage, 'evict', None)
+        if evict is not None:
+            evict(nbytes)
+
+    @contextmanager
+    def _heartbeat(self, keys):
+        """
+        Keep refreshing the claims on `keys` while computing shared,
+        so they don't time out.
+        """
+        timeout = getattr(self.storage, 'lock_timeout', None)
+        if not self._shared or not keys or timeout is None:
+            yield
+            return
+
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(timeout / 4):
+                for key in keys:
+                    self.storage.refresh_claim(key)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def plan(self, call, estimate=True):
+        """
+        Resolve the keys of `call` and its inputs against the storage
+        without loading or computing any values, see `Plan`.
+
+        Mapped operations are planned as a single node which is cached only if all
+        its elements are, determining the element keys requires loading their input.
+
+        estimate: Estimate runtimes of missing nodes from the metadata of all stored
+                  entries, disable if only the keys and their status are of interest.
+        """
+        from .plan import Plan
+
+        runtimes = defaultdict(list)
+        for meta in self.storage.iter_meta() if estimate else ():
+            if 'runtime' in meta:
+                runtimes[meta['function']].append(meta['runtime'])
+
+        nodes = []
+        used = self._used
+        try:
+            self._plan(call, {}, {}, nodes, runtimes)
+        finally:
+            self._used = used
+        return Plan(nodes)
+
+    def _plan(self, call, seen, planned, nodes, runtimes):
+        """
+        Returns a pair (value, node), value is None if it is not available
+        without computing, node is None for constants.
+
+        Like in `_compute()`, distinct but identical calls are resolved once:
+        `planned` holds the pairs by key (by operation and element keys for mapped operations,
+        by operation and inputs for pending ones).
+        """
+        from .calltree import Call, MapCall, Value, CallExecution
+        from .plan import PlanNode, CACHED, MISSING, PENDING
+
+        if id(call) in seen:
+            return seen[id(call)]
+
+        if not isinstance(call, Call):
+            r = seen[id(call)] = (call if isinstance(call, Value) else Value(value=call), None)
+            return r
+
+        args = [self._plan(a, seen, planned, nodes, runtimes) for a in call.args]
+        kws = {k: self._plan(v, seen, planned, nodes, runtimes) for k, v in call.kws.items()}
+        inputs = tuple(n for _, n in args + list(kws.values()) if n is not None)
+
+        key = None
+        value = None
+        meta = {}
+        if any(v is None for v, _ in args + list(kws.values())):
+            # No key without the input values, but identical inputs are the same nodes
+            def ident(pair):
+                value, node = pair
+                return value.get_hash() if node is None else id(node)
+            planned_key = (
+                type(call), getattr(call, 'chunk_size', None), call.operation.cache_hash(),
+                tuple(ident(a) for a in args), tuple(sorted((k, ident(v)) for k, v in kws.items()))
+            )
+            if planned_key in planned:
+                r = seen[id(call)] = planned[planned_key]
+                return r
+            status = PENDING
+        elif isinstance(call, MapCall):
+            return self._plan_map(call, [v for v, _ in args], {k: v for k, (v, _) in kws.items()},
+                    inputs, seen, planned, nodes, runtimes)
+        else:
+            execution = CallExecution(
+                call,
+                args=[v for v, _ in args],
+                kws={k: v for k, (v, _) in kws.items()}
+            )
+            key = planned_key = cache_hash(execution)
+            if key in planned:
+                r = seen[id(call)] = planned[key]
+                return r
+            try:
+                value = self._results[key] if key in self._results else self.storage.load(key)
+                status = CACHED
+            except KeyError:
+                status = MISSING
+
+        if status == CACHED:
+            try:
+                meta = self.storage.get_meta(key)
+            except KeyError:
+                pass
+            runtime = meta.get('runtime')
+        else:
+            history = runtimes.get(call.operation.f.__qualname__)
+            runtime = sum(history) / len(history) if history else None
+
+        node = PlanNode(call=call, key=key, status=status, size=meta.get('value_size'),
+                runtime=runtime, inputs=inputs)
+        nodes.append(node)
+        r = seen[id(call)] = planned[planned_key] = (value, node)
+        return r
+
+    def _plan_map(self, call, args, kws, inputs, seen, planned, nodes, runtimes):
+        from .plan import PlanNode, CACHED, MISSING
+
+        executions = self._map_executions(call, args, kws)
+        keys = [cache_hash(e) for e in executions]
+        # The operation tells apart maps over no elements
+        planned_key = (call.operation.cache_hash(),) + tuple(keys)
+        if planned_key in planned:
+            r = seen[id(call)] = planned[planned_key]
+            return r
+        results = [self._lookup(key) for key in keys]
+        metas = []
+        for key, r in zip(keys, results):
+            try:
+                metas.append(self.storage.get_meta(key) if r is not None else {})
+            except KeyError:
+                metas.append({})
+
+        value = None
+        history = runtimes.get(call.operation.f.__qualname__)
+        estimate = sum(history) / len(history) if history else None
+        missing = results.count(None)
+        if missing:
+            status = MISSING
+            runtime = None if estimate is None else estimate * missing
+            size = None
+        else:
+            status = CACHED
+            value = self._join(call, results)
+            runtime = sum(m.get('runtime', 0) for m in metas)
+            size = sum(m.get('value_size', 0) for m in metas)
+
+        node = PlanNode(call=call, key=None, status=status, size=size, runtime=runtime,
+                inputs=inputs, elements=tuple(keys))
+        nodes.append(node)
+        r = seen[id(call)] = planned[planned_key] = (value, node)
+        return r
+
+class AsyncSession(Session):
+    """
+    Session that can run `async def` operations. Independent branches of the call
+    graph are resolved concurrently on the event loop, with at most `max_concurrency`
+    operations running at the same time. Synchronous operations run in `executor`
+    (which must be thread based, the loop's default executor if None),
+    storage lookups, loads and saves in the loop's default executor.
+
+    >>> from .pipeline import operation
+    >>> from .storage import RamStorage
+    >>> @operation()
+    ... async def fetch(x):
+    ...     await asyncio.sleep(.1)
+    ...     return x * 2
+    >>> @operation()
+    ... def add(*xs):
+    ...     return sum(xs)
+    >>> s = AsyncSession(RamStorage())
+    >>> asyncio.run(s.compute(add(*[fetch(i) for i in range(10)]))).load_value()
+    90
+    """
+
+    def __init__(self, storage, memoize=True, executor=None, scheduler=None, max_concurrency=16):
+        super().__init__(storage, memoize=memoize, executor=executor, scheduler=scheduler)
+        self.max_concurrency = max_concurrency
+
+    async def compute(self, call):
+        if not self.memoize:
+            self._results = {}
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Futures of results being resolved, by key for structurally identical calls
+        self._pending = {}
+        try:
+            return await self._node(call, {})
+        finally:
+            await self._run(None, self._record_used)
+
+    async def _run(self, executor, f, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(f, *args))
+
+    def _node(self, call, tasks):
+        """
+        Future of the result of `call`, nodes occurring several times are resolved once.
+        """
+        if id(call) not in tasks:
+            tasks[id(call)] = asyncio.ensure_future(self._compute_async(call, tasks))
+        return tasks[id(call)]
+
+    async def _compute_async(self, call, tasks):
+        from .calltree import Call, MapCall, Value, CallExecution
+
+        if not isinstance(call, Call):
+            return call if isinstance(call, Value) else Value(value=call)
+
+        args = list(await asyncio.gather(*(self._node(a, tasks) for a in call.args)))
+        kws = dict(zip(
+            call.kws.keys(),
+            await asyncio.gather(*(self._node(v, tasks) for v in call.kws.values()))
+        ))
+
+        if isinstance(call, MapCall):
+            executions = await self._run(None, self._map_executions, call, args, kws)
+            keys = await self._run(None, lambda: [cache_hash(e) for e in executions])
+            results = await asyncio.gather(*(self._resolve(k, e) for k, e in zip(keys, executions)))
+            return self._join(call, results)
+
+        execution = CallExecution(call, args=args, kws=kws)
+        # Hashing may need to hash (or load) values
+        key = await self._run(None, cache_hash, execution)
+        return await self._resolve(key, execution)
+
+    async def _resolve(self, key, execution):
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(self._resolve_key(key, execution))
+        return await self._pending[key]
+
+    async def _resolve_key(self, key, execution):
+        result = await self._run(None, self._traced_lookup, key, execution.call)
+        if result is not None:
+            return result
+
+        async with self._semaphore:
+            if inspect.iscoroutinefunction(execution.call.operation.f):
+                result, timing = await self._timed_compute_async(execution)
+            else:
+                result, timing = await self._run(self.executor, self._scheduled_compute, execution)
+
+        return await self._run(None, self._save, key, execution, result, timing)
+
+    async def _timed_compute_async(self, execution):
+        from .calltree import Value
+
+        start = time.perf_counter()
+        args, kws = await self._run(None, execution.load_inputs)
+        t = time.perf_counter()
+        result = Value(value=await execution.call.operation.compute(args, kws))
+        # Memory can't be attributed to interleaved coroutines
+        return result, {
+            'start': start,
+            'load': t - start,
+            'compute': time.perf_counter() - t,
+            'thread': threading.get_ident(),
+            'memory': None,
+        }
 
@@ -1,83 +1,443 @@
 
 import os
+import sys
+import mmap
+import fcntl
+import time
 import pickle
+import socket
+import sqlite3
+import threading
+from collections import OrderedDict
 from icecream import ic
 
+from hashing import cache_hash
+
 class RamStorage:
     def __init__(self):
         self.hashes = {}
         self.values = {}
+        self.metas = {}
 
     def load(self, key):
+        from .calltree import Value
+
         if key not in self.hashes:
             raise KeyError()
         return Value(hash_=self.hashes[key], value=self.values[key])
 
-    def save(self, key, value):
+    def save(self, key, value, meta={}):
+        from .calltree import Value
+
         if isinstance(value, Value):
-            self.values[key] = value.value
-            self.hashes[key] = value.hash
+            self.values[key] = value.load_value()
+            self.hashes[key] = value.get_hash()
         else:
             self.values[key] = value
             self.hashes[key] = cache_hash(value)
+        self.metas[key] = dict(meta)
+
+    def get_meta(self, key):
+        return self.metas[key]
+
+    def iter_meta(self):
+        return iter(self.metas.values())
+
+    def keys(self):
+        return list(self.hashes.keys())
+
+class TieredStorage:
+    """
+    Keeps recently used values in memory up to `max_bytes` on top of a
+    `backend` storage (eg. `DiskStorage`). Saves are written through to the
+    backend, least recently used values are evicted from memory
+    (but stay in the backend).
+
+    Note that a `Session` with `memoize=True` keeps all its results alive
+    by itself, use `memoize=False` to have memory bounded by `max_bytes`.
+    """
+
+    def __init__(self, backend, max_bytes):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # key -> (Value, size), least recently used first
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        from .calltree import Value
+
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key][0]
+
+        value = self.backend.load(key)
+
+        def load_value():
+            v = value.load_value()
+            self._remember(key, value)
+            return v
+
+        return Value(hash_=value.get_hash(), loader=load_value)
+
+    def save(self, key, value, meta={}):
+        size = self.backend.save(key, value, meta=meta)
+        self._remember(key, value)
+        return size
+
+    def _remember(self, key, value):
+        try:
+            size = self.backend.get_meta(key)['value_size']
+        except KeyError:
+            size = sys.getsizeof(value.load_value())
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._values:
+                self.nbytes -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._values.popitem(last=False)
+                self.nbytes -= size
+
+    def evict(self, nbytes=None):
+        """
+        Drop least recently used values from memory until at least `nbytes`
+        have been freed (everything if `nbytes` is None).
+        Returns the number of bytes freed.
+        """
+        freed = 0
+        with self._lock:
+            while self._values and (nbytes is None or freed < nbytes):
+                _, (_, size) = self._values.popitem(last=False)
+                freed += size
+            self.nbytes -= freed
+        return freed
+
+    def get_meta(self, key):
+        return self.backend.get_meta(key)
+
+    def iter_meta(self):
+        return self.backend.iter_meta()
+
+    def keys(self):
+        return self.backend.keys()
+
+    def sizes(self):
+        return self.backend.sizes()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._values:
+                self.nbytes -= self._values.pop(key)[1]
+        self.backend.delete(key)
+
+    def record_session(self, session, keys):
+        self.backend.record_session(session, keys)
+
+    def session_keys(self, n):
+        return self.backend.session_keys(n)
+
+    def forget_sessions(self, keep):
+        self.backend.forget_sessions(keep)
+
+    def claim(self, key):
+        return self.backend.claim(key)
+
+    def refresh_claim(self, key):
+        self.backend.refresh_claim(key)
+
+    def release(self, key):
+        self.backend.release(key)
 
 class DiskStorage:
-    def __init__(self, base_dir):
+    """
+    Stores each value in a single container file (`<key>.v`: pickle stream
+    followed by page-aligned out-of-band buffers) and keeps hashes, metadata and
+    container layout in one SQLite index (`index.sqlite`), so lookups, listing and
+    metadata queries never touch the containers.
+    """
+
+    def __init__(self, base_dir, min_buffer_size=1 << 20, lock_timeout=60., wal=True):
+        """
+        base_dir:        Directory to store results in
+        min_buffer_size: Buffers (eg. numpy array data) of at least this size are
+                         pickled out-of-band into the page-aligned part of the
+                         container that is memory-mapped on load instead of being copied.
+        lock_timeout:    Seconds after which a claim (see `claim()`) that has not been
+                         refreshed is considered stale, so claims of crashed processes on
+                         other hosts are taken over. `Session.compute_shared()` refreshes
+                         its claims every quarter of this. Claims of dead processes on the
+                         same host are always considered stale. None never takes over
+                         claims of other hosts.
+        wal:             Use SQLite write-ahead logging for the index. WAL needs shared
+                         memory between the processes, so disable it if `base_dir` is on a
+                         filesystem that is shared between machines.
+        """
         self.base_dir = base_dir
+        self.min_buffer_size = min_buffer_size
+        self.lock_timeout = lock_timeout
+        self.wal = wal
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
 
-    def _get_hash_filename(self, key):
-        return self.base_dir + '/' + hex(abs(key)) + '_hash.p'
+    def _get_container_filename(self, key):
+        return self.base_dir + '/' + hex(abs(key)) + '.v'
 
-    def _get_value_filename(self, key):
-        return self.base_dir + '/' + hex(abs(key)) + '_value.p'
+    def _get_lock_filename(self, key):
+        return self.base_dir + '/' + hex(abs(key)) + '.lock'
 
-    def _get_meta_filename(self, key):
-        return self.base_dir + '/' + hex(abs(key)) + '_meta.p'
+    def _index(self, query, args=(), many=False):
+        """
+        Run `query` against the index and return all result rows.
+        If `many` is True, run it for each tuple of arguments in `args`.
+        """
+        with self._lock:
+            # Connections must not be shared with forked children
+            if self._connection is None or self._connection_pid != os.getpid():
+                os.makedirs(self.base_dir, exist_ok=True)
+                self._connection = sqlite3.connect(
+                    self.base_dir + '/index.sqlite', timeout=60, check_same_thread=False
+                )
+                self._connection_pid = os.getpid()
+                # Without WAL every commit syncs the whole journal, making saves
+                # of small values take tens of milliseconds
+                if self.wal:
+                    self._connection.execute('PRAGMA journal_mode=WAL')
+                    self._connection.execute('PRAGMA synchronous=NORMAL')
+                with self._connection:
+                    self._connection.execute(
+                        'CREATE TABLE IF NOT EXISTS entries ('
+                        'key TEXT PRIMARY KEY, hash BLOB, meta BLOB, '
+                        'data_size INTEGER, layout BLOB, size INTEGER)'
+                    )
+                    self._connection.execute(
+                        'CREATE TABLE IF NOT EXISTS sessions ('
+                        'session TEXT, time REAL, key TEXT, PRIMARY KEY (session, key))'
+                    )
+            with self._connection:
+                if many:
+                    return self._connection.executemany(query, args).fetchall()
+                return self._connection.execute(query, args).fetchall()
 
     def load(self, key):
         from .calltree import Value
 
-        filename = self._get_hash_filename(key)
-        if not os.path.exists(filename):
+        rows = self._index('SELECT hash, data_size, layout FROM entries WHERE key = ?', (hex(key),))
+        if not rows:
             raise KeyError()
-
-        with open(filename, 'rb') as f:
-            h = pickle.load(f)
+        h, data_size, layout = rows[0]
 
         def load_value():
-            filename = self._get_value_filename(key)
-            with open(filename, 'rb') as f:
-                v = pickle.load(f)
-            return v
+            with open(self._get_container_filename(key), 'rb') as f:
+                data = f.read(data_size)
+                buffers = []
+                offsets = pickle.loads(layout)
+                if offsets:
+                    # Copy-on-write: Pages are only read when accessed and
+                    # the loaded arrays stay writable without touching the file
+                    m = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+                    buffers = [m[offset:offset + size] for offset, size in offsets]
+            return pickle.loads(data, buffers=buffers)
 
-        r = Value(hash_=h)
-        r.load_value = load_value
-        return r
+        return Value(hash_=pickle.loads(h), loader=load_value)
 
-    @staticmethod
-    def load_meta(filename):
-        if not os.path.exists(filename):
+    def get_meta(self, key):
+        rows = self._index('SELECT meta FROM entries WHERE key = ?', (hex(key),))
+        if not rows:
             raise KeyError()
-        with open(filename, 'rb') as f:
-            h = pickle.load(f)
-        return h
+        return pickle.loads(rows[0][0])
+
+    def iter_meta(self):
+        for meta, in self._index('SELECT meta FROM entries'):
+            yield pickle.loads(meta)
+
+    def keys(self):
+        return [int(key, 16) for key, in self._index('SELECT key FROM entries')]
 
+    def sizes(self):
+        """
+        Size of the stored container for each key.
+        """
+        return {int(key, 16): size for key, size in self._index('SELECT key, size FROM entries')}
+
+    def delete(self, key):
+        self._index('DELETE FROM entries WHERE key = ?', (hex(key),))
+        try:
+            os.remove(self._get_container_filename(key))
+        except FileNotFoundError:
+            pass
+
+    def record_session(self, session, keys):
+        """
+        Remember that `session` used `keys`, see `session_keys()`.
+        """
+        t = time.time()
+        self._index(
+            'INSERT OR REPLACE INTO sessions (session, time, key) VALUES (?, ?, ?)',
+            [(session, t, hex(key)) for key in keys],
+            many=True
+        )
+
+    def _last_sessions(self, n):
+        return [
+            session for session, in self._index(
+                'SELECT session FROM sessions GROUP BY session ORDER BY MAX(time) DESC LIMIT ?',
+                (n,)
+            )
+        ]
+
+    def session_keys(self, n):
+        """
+        Keys used by the last `n` recorded sessions.
+        """
+        keys = set()
+        for session in self._last_sessions(n):
+            keys.update(
+                int(key, 16)
+                for key, in self._index('SELECT key FROM sessions WHERE session = ?', (session,))
+            )
+        return keys
+
+    def forget_sessions(self, keep):
+        """
+        Forget all but the last `keep` recorded sessions.
+        """
+        sessions = self._last_sessions(keep)
+        self._index(
+            'DELETE FROM sessions WHERE session NOT IN ({})'.format(', '.join('?' * len(sessions))),
+            sessions
+        )
 
     def save(self, key, value, meta={}):
-        if not os.path.exists(self.base_dir):
-            os.mkdir(self.base_dir)
+        buffers = []
+        def buffer_callback(buffer):
+            if buffer.raw().nbytes < self.min_buffer_size:
+                # Small enough, serialize in-band
+                return True
+            buffers.append(buffer)
+            return False
 
-        with open(self._get_hash_filename(key), 'wb') as f:
-            pickle.dump(value.get_hash(), f)
+        data = pickle.dumps(value.load_value(), protocol=5, buffer_callback=buffer_callback)
 
-        with open(self._get_value_filename(key), 'wb') as f:
-            pickle.dump(value.load_value(), f)
+        # (offset, size) for each out-of-band buffer in the container
+        layout = []
+        filename = self._get_container_filename(key)
+        os.makedirs(self.base_dir, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial container
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            for buffer in buffers:
+                raw = buffer.raw()
+                # Page-align each buffer so its mapping can't straddle a foreign page
+                offset = (f.tell() + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+                f.seek(offset)
+                f.write(raw)
+                layout.append((offset, raw.nbytes))
+            size = f.tell()
+        os.replace(tmp_filename, filename)
 
         meta = dict(meta)
-        meta['hash_filename'] = self._get_hash_filename(key)
-        meta['value_filename'] = self._get_value_filename(key)
-        meta['meta_filename'] = self._get_meta_filename(key)
+        meta['value_size'] = size
+        meta['filename'] = filename
+
+        self._index(
+            'INSERT OR REPLACE INTO entries (key, hash, meta, data_size, layout, size) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (hex(key), pickle.dumps(value.get_hash()), pickle.dumps(meta), len(data),
+                pickle.dumps(layout), size)
+        )
+        return size
+
+    def claim(self, key):
+        """
+        Atomically claim `key` for computation by creating its lock file.
+        Returns False if it is already claimed by another (live) process.
+        """
+        filename = self._get_lock_filename(key)
+        os.makedirs(self.base_dir, exist_ok=True)
+        # Second attempt only after breaking a stale lock
+        for _ in range(2):
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._break_stale_lock(filename):
+                    return False
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    f.write('{} {}'.format(socket.gethostname(), os.getpid()))
+                return True
+        return False
+
+    def refresh_claim(self, key):
+        os.utime(self._get_lock_filename(key))
+
+    def release(self, key):
+        try:
+            os.remove(self._get_lock_filename(key))
+        except FileNotFoundError:
+            pass
+
+    def _break_stale_lock(self, filename):
+        """
+        Remove `filename` if it is stale, returns True if the lock is gone.
+
+        Processes breaking a lock decide one at a time, holding an flock on
+        `<filename>.guard`: otherwise one of them could remove the fresh lock another
+        one took after removing the stale lock both had judged.
+
+        >>> import tempfile
+        >>> storage = DiskStorage(tempfile.mkdtemp(), lock_timeout=60)
+        >>> filename = storage._get_lock_filename(1)
+        >>> with open(filename, 'w') as f:
+        ...     _ = f.write('elsewhere 1')
+        >>> os.utime(filename, (0, 0))
+        >>> barrier = threading.Barrier(8)
+        >>> claims = []
+        >>> def claim():
+        ...     barrier.wait()
+        ...     claims.append(storage.claim(1))
+        >>> threads = [threading.Thread(target=claim) for _ in range(8)]
+        >>> for t in threads: t.start()
+        >>> for t in threads: t.join()
+        >>> claims.count(True)
+        1
+        """
+        with open(filename + '.guard', 'a') as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            try:
+                with open(filename, 'r') as f:
+                    host, pid = f.read().split()
+                age = time.time() - os.path.getmtime(filename)
+            except FileNotFoundError:
+                # Released in the meantime
+                return True
+            except ValueError:
+                # Just created, owner didn't write its name yet
+                return False
+
+            dead = host == socket.gethostname() and not _pid_alive(int(pid))
+            if not dead and (self.lock_timeout is None or age < self.lock_timeout):
+                return False
+
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            return True
 
-        with open(self._get_meta_filename(key), 'wb') as f:
-            pickle.dump(meta, f)
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
@@ -0,0 +1,112 @@
+
+import json
+import os
+import time
+import threading
+from collections import namedtuple, defaultdict
+
+from text import format_table
+
+# Node was answered from the session's memo / loaded from storage / computed
+MEMO = 'memo'
+HIT = 'hit'
+MISS = 'miss'
+
+# Times are in seconds, `start` (of loading, followed by computing) and `save_start`
+# relative to the creation of the `RunTrace`. Computing may happen in an executor,
+# `thread` is where, saving always happens in `save_thread`.
+# `memory` is the peak memory growth while computing (see `Session`).
+NodeRecord = namedtuple(
+    'NodeRecord',
+    ('operation', 'key', 'status', 'start', 'load', 'compute', 'save_start', 'save', 'nbytes',
+        'memory', 'thread', 'save_thread')
+)
+
+class RunTrace:
+    """
+    Per-node record of what a `Session` did: cache status, time spent loading
+    inputs (or looking up the result for hits), computing and saving,
+    bytes written to storage and peak memory growth.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.records = []
+
+    def add(self, call, key, status, start, load=0., compute=0., save_start=None, save=0.,
+            nbytes=None, memory=None, thread=None):
+        save_start = start + load + compute if save_start is None else save_start
+        self.records.append(NodeRecord(
+            operation=str(call.operation), key=key, status=status, start=start - self.t0,
+            load=load, compute=compute, save_start=save_start - self.t0, save=save, nbytes=nbytes,
+            memory=memory, thread=thread or threading.get_ident(), save_thread=threading.get_ident()
+        ))
+
+    def get_summary(self):
+        """
+        Yield (operation, nodes, hits, misses, load, compute, save, nbytes, memory) per operation,
+        by descending total time. Hits include nodes answered from the session's memo,
+        `memory` is the maximum over all nodes.
+        """
+        rows = defaultdict(lambda: [0, 0, 0, 0., 0., 0., 0, 0])
+        for r in self.records:
+            row = rows[r.operation]
+            row[0] += 1
+            row[1] += r.status != MISS
+            row[2] += r.status == MISS
+            row[3] += r.load
+            row[4] += r.compute
+            row[5] += r.save
+            row[6] += r.nbytes or 0
+            row[7] = max(row[7], r.memory or 0)
+
+        l = list(rows.items())
+        l.sort(key=lambda kv: -(kv[1][3] + kv[1][4] + kv[1][5]))
+        for name, row in l:
+            yield (name, *row)
+
+    def format_summary(self, summary=None):
+        if summary is None:
+            summary = self.get_summary()
+        return format_table(
+            [
+                (name, nodes, hits, misses, '{:.3f}'.format(load), '{:.3f}'.format(compute),
+                    '{:.3f}'.format(save), nbytes, memory)
+                for name, nodes, hits, misses, load, compute, save, nbytes, memory in summary
+            ],
+            ('operation', 'nodes', 'hits', 'misses', 'load', 'compute', 'save', 'bytes', 'memory')
+        )
+
+    def get_chrome_trace(self):
+        """
+        Trace in Chrome trace-event format (for chrome://tracing or Perfetto),
+        one event per node with its load and compute phases nested inside,
+        and one for saving.
+        """
+        pid = os.getpid()
+        events = []
+        def event(name, cat, tid, start, duration, **args):
+            events.append({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': start * 1e6, 'dur': duration * 1e6, 'args': args,
+            })
+
+        for r in self.records:
+            event(r.operation, r.status, r.thread, r.start, r.load + r.compute,
+                key=hex(abs(r.key)), status=r.status, memory=r.memory)
+            if r.load:
+                event('load', r.status, r.thread, r.start, r.load)
+            if r.compute:
+                event('compute', r.status, r.thread, r.start + r.load, r.compute)
+            if r.save:
+                event('save ' + r.operation, r.status, r.save_thread, r.save_start, r.save,
+                    key=hex(abs(r.key)), bytes=r.nbytes)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.get_chrome_trace(), f)
+
+    def __str__(self):
+        return self.format_summary()
+
@@ -47,6 +47,137 @@ class Stats:
             )
         return r
 
+class LatencyHistogram:
+    """
+    Histogram of non-negative integer values (eg. latencies in ns) with logarithmic buckets
+    (HDR histogram style): values below 2 ** (precision + 1) are counted exactly, larger ones in
+    2 ** precision buckets per power of two, so quantiles are accurate to a relative error of
+    2 ** -precision with memory bounded by the number of buckets, independent of the number of values.
+    Histograms of the same precision can be merged (eg. across processes or time windows).
+
+    >>> h = LatencyHistogram(precision=4)
+    >>> for v in range(1, 1001):
+    ...     h.record(v)
+    >>> h.count, h.min, h.max, len(h.counts)
+    (1000, 1, 1000, 111)
+    >>> [h.percentile(p) for p in (50, 90, 99, 100)]
+    [503, 911, 975, 1000]
+    >>> h2 = LatencyHistogram.from_dict(h.to_dict()).merge(h)
+    >>> h2.count, h2.percentile(50)
+    (2000, 503)
+    """
+
+    __slots__ = ('precision', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        # bucket index -> count
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket(self, value):
+        """
+        Index of the bucket for `value`.
+        """
+        shift = value.bit_length() - self.precision - 1
+        if shift <= 0:
+            return value
+        return (shift << self.precision) + (value >> shift)
+
+    def bucket_range(self, index):
+        """
+        (lowest, highest) value counted in bucket `index`.
+        """
+        shift = (index >> self.precision) - 1
+        if shift <= 0:
+            return index, index
+        m = index - (shift << self.precision)
+        return m << shift, ((m + 1) << shift) - 1
+
+    def record(self, value, n=1):
+        # `bucket()` inlined, this is on the hot path of `Timer`
+        shift = value.bit_length() - self.precision - 1
+        i = value if shift <= 0 else (shift << self.precision) + (value >> shift)
+        self.counts[i] = self.counts.get(i, 0) + n
+        self.count += n
+        self.total += value * n
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values of `other` to this histogram, returns self.
+        """
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge histograms of precision {} and {}'.format(self.precision, other.precision))
+        # copy() is atomic, `other` may be recorded to concurrently
+        for i, n in other.counts.copy().items():
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+        return self
+
+    def copy(self):
+        return LatencyHistogram(self.precision).merge(self)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """
+        Value below or equal to which `p` percent of the recorded values are
+        (middle of the bucket, clamped to the exact min and max).
+        """
+        if not self.count:
+            return 0
+        rank = max(1, -int(-p * self.count // 100))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                low, high = self.bucket_range(i)
+                return min(max((low + high) // 2, self.min), self.max)
+        return self.max
+
+    def count_at_most(self, value):
+        """
+        Number of recorded values less than or equal to `value`
+        (up to the resolution of the buckets).
+        """
+        last = self.bucket(value)
+        return sum(n for i, n in self.counts.copy().items() if i <= last)
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        return {p: self.percentile(p) for p in ps}
+
+    def to_dict(self):
+        """
+        JSON-serializable representation, see `from_dict()`.
+        """
+        return {
+            'precision': self.precision, 'counts': sorted(self.counts.copy().items()),
+            'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(d['precision'])
+        h.counts = {i: n for i, n in d['counts']}
+        h.count = d['count']
+        h.total = d['total']
+        h.min = d['min']
+        h.max = d['max']
+        return h
+
 def outliers(a, f=1.5):
     import numpy as np
     Q1, Q3 = np.percentile(a, q=[25, 75])
@@ -1,17 +1,265 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import json
+import struct
 import time
+import tracemalloc
+import asyncio
+import fnmatch
+import inspect
+import itertools
+import threading
+import weakref
+import contextvars
 from collections import namedtuple, defaultdict
 from typing import List, Tuple
 from functools import wraps
 
 from .text import format_table
+from .stats import LatencyHistogram
+from .osutil import rss as _rss
+
+# Innermost section open in the current thread / asyncio task as (section id, start ns, path,
+# memory, thread, task, outer), None if there is none. Path is the tuple of ids of all open
+# sections, memory the state at the start for sections recording memory (else None,
+# see `Timer._memory_start()`), thread and task the ids the section is recorded with
+# and outer the entry of the section it is nested in (None at the top).
+# Tasks start with a copy of the context they were created in and threads
+# with an empty one, so nesting is tracked per execution context.
+_open_sections = contextvars.ContextVar('timer_open_sections', default=None)
+
+# Bound once, `Timer.__enter__()` and `__exit__()` are on the hot path
+_perf_counter_ns = time.perf_counter_ns
+_get_ident = threading.get_ident
+_get_running_loop = asyncio._get_running_loop
+
+def _current_task_id():
+    # Checking for a running event loop first is much cheaper than
+    # letting `current_task()` raise outside of one
+    if asyncio._get_running_loop() is None:
+        return None
+    task = asyncio.current_task()
+    return None if task is None else id(task)
+
+# Snapshot of a node of the profile tree, times in seconds.
+# `inclusive` is the total time spent in the section, `self` the part not spent in
+# sub-sections (concurrent sub-sections, eg. asyncio tasks, can make it negative).
+# `latency` is a `LatencyHistogram` of the durations in ns,
+# `memory` `MemoryStats` if the section records memory, else None.
+SectionStats = namedtuple('SectionStats', ('path', 'inclusive', 'self', 'calls', 'min', 'max', 'latency', 'memory'))
+
+# Memory use of a section over `calls` calls, in bytes: sum and maximum of the growth of
+# resident memory (RSS), maximum peak of memory traced by `tracemalloc` above the start
+# (None if not tracing) and sum of the growth of the number of allocated memory blocks.
+# Memory is process-wide, so sections running concurrently are included.
+MemoryStats = namedtuple('MemoryStats', ('calls', 'rss', 'rss_max', 'peak', 'blocks'))
+
+class _MemoryNode:
+    __slots__ = ('calls', 'rss', 'rss_max', 'peak', 'blocks')
+
+    def __init__(self):
+        self.calls = 0
+        self.rss = 0
+        self.rss_max = 0
+        self.peak = None
+        self.blocks = 0
+
+    def add(self, rss, peak, blocks):
+        self.calls += 1
+        self.rss += rss
+        self.rss_max = max(self.rss_max, rss)
+        if peak is not None:
+            self.peak = peak if self.peak is None else max(self.peak, peak)
+        self.blocks += blocks
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.rss += other.rss
+        self.rss_max = max(self.rss_max, other.rss_max)
+        if other.peak is not None:
+            self.peak = other.peak if self.peak is None else max(self.peak, other.peak)
+        self.blocks += other.blocks
+
+    def snapshot(self):
+        return MemoryStats(self.calls, self.rss, self.rss_max, self.peak, self.blocks)
+
+    @classmethod
+    def from_snapshot(cls, stats):
+        m = cls()
+        m.calls, m.rss, m.rss_max, m.peak, m.blocks = stats
+        return m
+
+class _ThreadEnd:
+    """
+    Kept in a thread's local data only, to be notified when the thread ends.
+    """
+    __slots__ = ('__weakref__',)
+
+class _ProfileNode:
+    """
+    Statistics of one path of sections in one thread, times in nanoseconds.
+    """
+    __slots__ = ('children', 'latency', 'memory')
+
+    def __init__(self):
+        self.children = 0
+        # Durations of the calls, also giving their number, sum, minimum and maximum
+        self.latency = LatencyHistogram()
+        self.memory = None
+
+    inclusive = property(lambda self: self.latency.total)
+    calls = property(lambda self: self.latency.count)
+    min = property(lambda self: self.latency.min)
+    max = property(lambda self: self.latency.max)
+
+    def merge(self, other):
+        self.children += other.children
+        self.latency.merge(other.latency)
+        if other.memory is not None:
+            if self.memory is None:
+                self.memory = _MemoryNode()
+            self.memory.merge(other.memory)
+        return self
+
+    def to_dict(self):
+        return {
+            'inclusive': self.inclusive, 'children': self.children, 'calls': self.calls,
+            'min': self.min, 'max': self.max, 'latency': self.latency.to_dict(),
+            'memory': None if self.memory is None else list(self.memory.snapshot()),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        node = cls()
+        node.children = d['children']
+        node.latency = LatencyHistogram.from_dict(d['latency'])
+        if d['memory'] is not None:
+            node.memory = _MemoryNode.from_snapshot(d['memory'])
+        return node
+
+# Record of an ended section: section id, level, start and end (ns), thread id, task id (0 if none)
+_SECTION = struct.Struct('=IIqqQQ')
+_pack_section = _SECTION.pack_into
+_SECTION_SIZE = _SECTION.size
+
+class EventBuffer:
+    """
+    Preallocated ring buffer of `Timer` events. When a section ends, its start and stop
+    are stored together as one fixed size record in a bytearray (packing a record is a single
+    call, much cheaper than storing each event or field), so sections still open are not included.
+    Reads as a sequence of `Timer.Event` ordered by time.
+
+    capacity: Number of events kept, two per section
+    overflow: What to do when more than `capacity` events are recorded:
+              'overwrite' the oldest ones, 'drop' new ones or raise an OverflowError ('error').
+
+    Slots are allocated without a lock, so recording from several threads is safe;
+    a section counts as recorded once written, while other threads record concurrently
+    the count may briefly lag behind.
+
+    >>> b = EventBuffer(capacity=4)
+    >>> for t in range(3):
+    ...     b.append(Timer.section_id('x'), 0, t, t + 1, 1, 0)
+    >>> len(b), b.recorded, b.dropped, [(e.event, round(e.t * 1e9)) for e in b]
+    (4, 6, 2, [('START', 1), ('STOP', 2), ('START', 2), ('STOP', 3)])
+    """
+
+    OVERFLOW_POLICIES = ('overwrite', 'drop', 'error')
+
+    def __init__(self, capacity=1 << 16, overflow='overwrite'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {}, not {!r}'.format(self.OVERFLOW_POLICIES, overflow))
+        self.capacity = capacity
+        self.overflow = overflow
+        # Number of section records
+        self._size = max(1, capacity // 2)
+        self.clear()
+
+    def clear(self):
+        self._buffer = bytearray(_SECTION.size * self._size)
+        self._slots = itertools.count()
+        # Number of sections recorded, set after a slot is written
+        self._recorded = 0
+        # (number of sections recorded, events) of the last read
+        self._cache = None
+
+    def append(self, section, level, start, end, thread, task):
+        """
+        Record a section that ended, times in nanoseconds.
+        """
+        # next() on a count is atomic
+        i = next(self._slots)
+        j = i % self._size
+        if j == i or self._accept():
+            _pack_section(self._buffer, j * _SECTION.size, section, level, start, end, thread, task or 0)
+        self._recorded = i + 1
+
+    def _accept(self):
+        """
+        Whether to store a section while the buffer is full.
+        """
+        if self.overflow == 'error':
+            raise OverflowError('Timer event buffer full ({} events)'.format(self.capacity))
+        return self.overflow == 'overwrite'
+
+    @property
+    def recorded(self):
+        """
+        Number of events recorded (including dropped ones).
+        """
+        return 2 * self._recorded
+
+    @property
+    def dropped(self):
+        """
+        Number of events recorded but no longer (or never) stored.
+        """
+        return self.recorded - len(self)
+
+    def __len__(self):
+        return 2 * min(self._recorded, self._size)
+
+    def _events(self):
+        """
+        Retained events, ordered by time. At equal times stops come before starts,
+        inner sections start after and stop before outer ones.
+        Cached until the next section is recorded.
+        """
+        recorded = self._recorded
+        cache = self._cache
+        if cache is not None and cache[0] == recorded:
+            return cache[1]
+        keyed = []
+        for j in range(min(recorded, self._size)):
+            section, level, start, end, thread, task = _SECTION.unpack_from(self._buffer, j * _SECTION.size)
+            name = Timer.section_names[section]
+            keyed.append(((start, 1, level), Timer.Event(Timer.START, name, start * 1e-9, level, thread, task or None)))
+            keyed.append(((end, 0, -level), Timer.Event(Timer.STOP, name, end * 1e-9, level, thread, task or None)))
+        keyed.sort(key=lambda k: k[0])
+        events = [event for _, event in keyed]
+        self._cache = (recorded, events)
+        return events
+
+    def __getitem__(self, i):
+        return self._events()[i]
+
+    def __iter__(self):
+        return iter(self._events())
 
 class Timer:
     """
-    TODO: get_stats() probably doesn't handle recursive functions correctly currently
+    Context manager for timing execution of code blocks.
+    Safe to use from several threads and asyncio tasks at once: nesting is tracked
+    per thread and task, events are tagged with the ids of both.
+
+    The most recent events are kept in the bounded `Timer.events` (see `configure()`),
+    a section's start and stop are added when it ends.
+    As sections end, a profile tree (one node per path of nested sections) is updated,
+    so statistics stay exact when events are dropped and are cheap to query while running.
+    Times are from `time.perf_counter_ns()`, in seconds.
 
-    Context manager for timing execution of code blocks
     >>> with Timer("frobnizing"):
     ...     a = 1 + 1
 
@@ -26,65 +274,647 @@ class Timer:
     ['frobnizing...', 'frobnizing done (...s)']
     >>> list(Timer.get_stats()) # doctest: +ELLIPSIS
     [('frobnizing', ..., 1)]
+
+    >>> def fib(n):
+    ...     with Timer("fib"):
+    ...         return n if n < 2 else fib(n - 1) + fib(n - 2)
+    >>> fib(3)
+    2
+    >>> p = Timer.get_profile()
+    >>> p['fib',].calls, p['fib', 'fib'].calls, p['fib', 'fib', 'fib'].calls
+    (1, 2, 2)
+    >>> [(name, calls) for name, tot, calls in Timer.get_stats()] # doctest: +ELLIPSIS
+    [...('fib', 5)...]
+    >>> dict((name, tot) for name, tot, calls in Timer.get_stats())['fib'] == p['fib',].inclusive
+    True
+    >>> Timer.get_latencies()['fib'].count
+    5
+
+    Generator functions decorated with a Timer are timed per resumption:
+
+    >>> @Timer("count")
+    ... def count(n):
+    ...     yield from range(n)
+    >>> list(count(3)), Timer.get_latencies()['count'].count
+    ([0, 1, 2], 4)
+
+    With `memory=True`, sections also record memory use (see `MemoryStats`):
+
+    >>> with Timer("allocate", memory=True):
+    ...     l = [object() for i in range(10000)]
+    >>> Timer.get_memory()['allocate'].blocks >= 10000
+    True
     """
-    Event = namedtuple('Event', ('event', 'name', 't', 'level'))
+    Event = namedtuple('Event', ('event', 'name', 't', 'level', 'thread', 'task'), defaults=(None, None))
 
     START = 'START'
     STOP = 'STOP'
-    level = 0
-    events: List[Event] = []
+    events: EventBuffer = EventBuffer()
+
+    # Interned section names, id -> name
+    section_names: List[str] = []
+    _section_ids = {}
+
+    # (thread id, profile tree {path: _ProfileNode}) of the running threads that used a Timer
+    _thread_stats: List[Tuple[int, dict]] = []
+    # Profile tree of the threads that ended, see `_fold_ended_thread()`
+    _ended_stats = {}
+    # Profile trees merged from other processes, {worker: {path: _ProfileNode}}
+    _workers = {}
+    # Active `SamplingProfiler`, while set the innermost section of each thread
+    # is kept in `_thread_sections` {thread id: path of section ids}
+    sampler = None
+    _thread_sections = {}
+    _local = threading.local()
+    _lock = threading.Lock()
+
+    __slots__ = ('name', 'id', 'memory')
 
-    def __init__(self, name):
+    def __init__(self, name, memory=False):
+        """
+        memory: Record memory use of the section (at some cost, see `MemoryStats`),
+                start `tracemalloc` to also record peaks of traced memory
+        """
         self.name = name
+        self.id = Timer._section_ids.get(name)
+        if self.id is None:
+            self.id = Timer.section_id(name)
+        self.memory = memory
 
     def __call__(self, f):
         # Be a decorator
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def new_coroutine_f(*args, **kws):
+                with self:
+                    return await f(*args, **kws)
+            return new_coroutine_f
+
+        if inspect.isgeneratorfunction(f):
+            # Each resumption (up to the next value) is a call of the section,
+            # the time the generator is suspended in between is not counted
+            @wraps(f)
+            def new_generator_f(*args, **kws):
+                gen = f(*args, **kws)
+                resume, arg = gen.send, None
+                while True:
+                    try:
+                        with self:
+                            item = resume(arg)
+                    except StopIteration as e:
+                        return e.value
+                    try:
+                        arg = yield item
+                        resume = gen.send
+                    except GeneratorExit:
+                        with self:
+                            gen.close()
+                        raise
+                    except BaseException as e:
+                        resume, arg = gen.throw, e
+            return new_generator_f
+
         @wraps(f)
         def new_f(*args, **kws):
             with self:
                 return f(*args, **kws)
         return new_f
 
+    @staticmethod
+    def _matches(name, patterns):
+        if isinstance(patterns, str):
+            patterns = (patterns,)
+        return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+    @classmethod
+    def instrument(cls, target, include='*', exclude=()):
+        """
+        Wrap the functions of module or class `target` in place in sections
+        named '<module>.<qualified name>': Functions defined in the module, methods
+        (also static and class methods) of classes defined there, recursively.
+        `include` and `exclude` are fnmatch patterns (or iterables of them) for the
+        qualified names (eg. 'DataFrame.get_*').
+        Generator functions are timed per resumption (see `Timer`), asynchronous
+        generators are left alone.
+        Modules that imported a function by name before keep calling the original.
+        Timer and the classes it uses itself are never wrapped.
+        Undo with `uninstrument()`. Returns the number of functions wrapped.
+        """
+        if inspect.ismodule(target):
+            module = target.__name__
+            members = [
+                (name, v) for name, v in vars(target).items()
+                if getattr(v, '__module__', None) == module
+            ]
+        else:
+            module = target.__module__
+            members = list(vars(target).items())
+
+        n = 0
+        for name, v in members:
+            if getattr(v, '__module__', None) == __name__ or v is LatencyHistogram:
+                # Used by Timer itself
+                continue
+            if inspect.isclass(v):
+                if v.__qualname__.startswith(getattr(target, '__qualname__', '') + '.') or inspect.ismodule(target):
+                    n += cls.instrument(v, include, exclude)
+                continue
+
+            f = v.__func__ if isinstance(v, (staticmethod, classmethod)) else v
+            if not inspect.isfunction(f) or hasattr(f, '__timer_original__'):
+                continue
+            if inspect.isasyncgenfunction(f):
+                continue
+            if not cls._matches(f.__qualname__, include) or cls._matches(f.__qualname__, exclude):
+                continue
+
+            wrapped = Timer('{}.{}'.format(module, f.__qualname__))(f)
+            wrapped.__timer_original__ = v
+            setattr(target, name, type(v)(wrapped) if f is not v else wrapped)
+            n += 1
+        return n
+
+    @classmethod
+    def uninstrument(cls, target):
+        """
+        Undo `instrument()` on module or class `target`.
+        """
+        for name, v in list(vars(target).items()):
+            if inspect.isclass(v) and v is not target and (
+                    inspect.ismodule(target) and v.__module__ == target.__name__
+                    or v.__qualname__.startswith(getattr(target, '__qualname__', '') + '.')):
+                cls.uninstrument(v)
+                continue
+            f = v.__func__ if isinstance(v, (staticmethod, classmethod)) else v
+            original = getattr(f, '__timer_original__', None)
+            if original is not None:
+                setattr(target, name, original)
+
+    @classmethod
+    def section_id(cls, name):
+        """
+        Interned id of the section `name`.
+        """
+        try:
+            return cls._section_ids[name]
+        except KeyError:
+            with cls._lock:
+                if name not in cls._section_ids:
+                    cls._section_ids[name] = len(cls.section_names)
+                    cls.section_names.append(name)
+                return cls._section_ids[name]
+
+    @classmethod
+    def configure(cls, capacity=None, overflow=None):
+        """
+        Replace the event buffer with one of `capacity` events and `overflow` policy
+        (see `EventBuffer`), unchanged settings are kept. Recorded events are discarded,
+        statistics are kept.
+        """
+        cls.events = EventBuffer(
+            capacity=cls.events.capacity if capacity is None else capacity,
+            overflow=cls.events.overflow if overflow is None else overflow
+        )
+
+    @classmethod
+    def reset(cls):
+        """
+        Discard all events and statistics.
+        """
+        cls.events.clear()
+        with cls._lock:
+            for _, stats in cls._thread_stats:
+                stats.clear()
+            cls._ended_stats = {}
+            cls._workers.clear()
+
+    @classmethod
+    def _get_thread_stats(cls):
+        try:
+            return cls._local.stats
+        except AttributeError:
+            stats = cls._local.stats = {}
+            # Released with the thread-local data when the thread ends
+            end = cls._local.end = _ThreadEnd()
+            weakref.finalize(end, cls._fold_ended_thread, stats).atexit = False
+            with cls._lock:
+                cls._thread_stats.append((threading.get_ident(), stats))
+            return stats
+
+    @classmethod
+    def _fold_ended_thread(cls, stats):
+        """
+        Merge the profile tree `stats` of a thread that ended into `_ended_stats`,
+        so the trees kept do not grow with the number of (short-lived) threads.
+        """
+        with cls._lock:
+            cls._thread_stats[:] = [(t, s) for t, s in cls._thread_stats if s is not stats]
+            # Merged into new nodes, readers may be merging the current ones
+            ended = dict(cls._ended_stats)
+            for path, node in stats.items():
+                merged = _ProfileNode()
+                if path in ended:
+                    merged.merge(ended[path])
+                ended[path] = merged.merge(node)
+            cls._ended_stats = ended
+
+    @staticmethod
+    def context_of(event):
+        """
+        Execution context (thread, task) `event` happened in.
+        """
+        return event.thread, event.task
+
     @classmethod
     def get_log(cls):
-        import sys
-        stack = []
+        # One stack per execution context. Only the retained events are shown,
+        # so sections may have started before the first or still be open.
+        stacks = defaultdict(list)
         for event in cls.events:
+            stack = stacks[cls.context_of(event)]
             if event.event == cls.START:
                 stack.append(event)
                 yield cls.format_message(event.level, '{}...'.format(event.name))
             elif event.event == cls.STOP:
+                if not stack:
+                    yield cls.format_message(event.level, '{} done'.format(event.name))
+                    continue
                 assert stack[-1].name == event.name
                 yield cls.format_message(event.level, '{} done ({:.3f}s)'.format(event.name, event.t - stack[-1].t))
                 stack.pop()
-        assert not len(stack)
+
+    PERCENTILES = (50, 90, 99, 99.9)
 
     @classmethod
-    def format_stats(cls, stats = None):
-        if stats is None:
-            stats = tuple(cls.get_stats())
-        return format_table(stats, ('name', 'tot', 'calls'))
+    def _get_intervals(cls):
+        """
+        Yield (context, name, level, start, end) of the sections in the retained events
+        by end time. Sections still open end at the last event,
+        sections whose start is no longer retained are left out.
+        """
+        stacks = defaultdict(list)
+        t_end = None
+        for event in cls.events:
+            t_end = event.t
+            context = cls.context_of(event)
+            stack = stacks[context]
+            if event.event == cls.START:
+                stack.append(event)
+            elif stack:
+                start = stack.pop()
+                yield context, start.name, start.level, start.t, event.t
+        for context, stack in stacks.items():
+            while stack:
+                start = stack.pop()
+                yield context, start.name, start.level, start.t, t_end
+
+    @staticmethod
+    def format_context(context):
+        thread, task = context
+        return 'thread {}'.format(thread) if task is None else 'task {} (thread {})'.format(task, thread)
 
     @classmethod
-    def get_stats(cls):
-        stack = []
-        tot_time = defaultdict(float)
-        calls = defaultdict(int)
+    def get_chrome_trace(cls):
+        """
+        Retained events in Chrome trace-event format (for chrome://tracing or Perfetto),
+        one track per thread and asyncio task.
+        """
+        pid = os.getpid()
+        t0 = cls.events[0].t if len(cls.events) else 0.
+        events = []
+        tids = {}
+        for context, name, level, start, end in cls._get_intervals():
+            if context not in tids:
+                thread, task = context
+                tids[context] = thread if task is None else task
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tids[context],
+                    'args': {'name': cls.format_context(context)},
+                })
+            events.append({
+                'name': name, 'cat': 'timer', 'ph': 'X', 'pid': pid, 'tid': tids[context],
+                'ts': (start - t0) * 1e6, 'dur': (end - start) * 1e6, 'args': {'level': level},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
 
+    @classmethod
+    def write_chrome_trace(cls, filename):
+        with open(filename, 'w') as f:
+            json.dump(cls.get_chrome_trace(), f)
+
+    @classmethod
+    def get_speedscope(cls, name='Timer'):
+        """
+        Retained events in speedscope format (https://www.speedscope.app),
+        one evented profile per thread and asyncio task.
+        """
+        profiles = {}
+        stacks = defaultdict(list)
+        t_end = 0.
         for event in cls.events:
+            t_end = event.t
+            context = cls.context_of(event)
+            if context not in profiles:
+                profiles[context] = {
+                    'type': 'evented', 'name': cls.format_context(context), 'unit': 'seconds',
+                    'startValue': event.t, 'endValue': event.t, 'events': [],
+                }
+            stack = stacks[context]
             if event.event == cls.START:
-                stack.append(event)
-            elif event.event == cls.STOP:
-                assert stack[-1].name == event.name
-                tot_time[event.name] += event.t - stack[-1].t
-                calls[event.name] += 1
+                stack.append(event.name)
+                kind = 'O'
+            elif stack:
                 stack.pop()
-        # assert not len(stack)
+                kind = 'C'
+            else:
+                continue
+            profiles[context]['events'].append({'type': kind, 'frame': cls._section_ids[event.name], 'at': event.t})
+            profiles[context]['endValue'] = event.t
+
+        for context, stack in stacks.items():
+            # Close sections still open
+            while stack:
+                profiles[context]['events'].append(
+                    {'type': 'C', 'frame': cls._section_ids[stack.pop()], 'at': t_end}
+                )
+                profiles[context]['endValue'] = t_end
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'timer.py',
+            'shared': {'frames': [{'name': n} for n in cls.section_names]},
+            'profiles': list(profiles.values()),
+        }
+
+    @classmethod
+    def write_speedscope(cls, filename, name='Timer'):
+        with open(filename, 'w') as f:
+            json.dump(cls.get_speedscope(name), f)
+
+    @classmethod
+    def get_collapsed_stacks(cls, by_thread=False):
+        """
+        Yield lines 'outer;inner;... <self time in µs>' per path of sections
+        for flamegraph tools, from the (exact) profile tree.
+
+        by_thread: Make the thread the root of each stack, or the worker
+                   for profiles merged from workers (see `merge_profile()`).
+        """
+        if by_thread:
+            with cls._lock:
+                roots = [('thread {}'.format(thread), stats.copy()) for thread, stats in cls._thread_stats]
+                roots.append(('ended threads', cls._ended_stats))
+                roots += [('worker {}'.format(w), stats) for w, stats in cls._workers.items()]
+        else:
+            roots = [(None, cls._get_tree())]
+        self_time = defaultdict(int)
+        for root, stats in roots:
+            for path, node in stats.items():
+                names = [cls.section_names[s].replace(';', ',') for s in path]
+                if root is not None:
+                    names.insert(0, root)
+                self_time[';'.join(names)] += max(0, node.inclusive - node.children)
+        for stack, ns in sorted(self_time.items()):
+            if ns >= 1000:
+                yield '{} {}'.format(stack, ns // 1000)
+
+    @classmethod
+    def write_collapsed_stacks(cls, filename, by_thread=False):
+        with open(filename, 'w') as f:
+            for line in cls.get_collapsed_stacks(by_thread):
+                f.write(line + '\n')
+
+    @classmethod
+    def format_stats(cls, stats = None, latency = False, memory = None):
+        """
+        latency: Add columns with latency percentiles (see `PERCENTILES`) and maximum.
+        memory:  Add columns with memory use (see `get_memory()`),
+                 by default if any section recorded it.
+        """
+        if stats is None:
+            stats = tuple(cls.get_stats())
+        rows = [tuple(row) for row in stats]
+        headers = ('name', 'tot', 'calls')
+
+        if latency:
+            latencies = cls.get_latencies()
+            for i, row in enumerate(rows):
+                h = latencies[row[0]]
+                rows[i] += tuple(
+                    '{:.6f}'.format(v * 1e-9) for v in (*h.percentiles(cls.PERCENTILES).values(), h.max)
+                )
+            headers += tuple('p{:g}'.format(p).replace('.', '') for p in cls.PERCENTILES) + ('max',)
+
+        memories = cls.get_memory()
+        if memory is None:
+            memory = bool(memories)
+        if memory:
+            for i, row in enumerate(rows):
+                m = memories.get(row[0])
+                rows[i] += ('', '', '', '') if m is None else (
+                    m.rss, m.rss_max, '' if m.peak is None else m.peak, m.blocks
+                )
+            headers += ('rss', 'rss max', 'peak', 'blocks')
+
+        return format_table(rows, headers)
+
+    @classmethod
+    def get_memory(cls):
+        """
+        {section name: `MemoryStats`} of the sections recording memory, over all paths and threads.
+        Growth within recursive calls is counted only once.
+        """
+        memories = {}
+        for path, node in cls._get_tree().items():
+            if node.memory is None:
+                continue
+            section = path[-1]
+            name = cls.section_names[section]
+            m = node.memory
+            if section in path[:-1]:
+                # Included in the outer call
+                m = _MemoryNode()
+                m.calls, m.rss_max, m.peak = node.memory.calls, node.memory.rss_max, node.memory.peak
+            if name not in memories:
+                memories[name] = _MemoryNode()
+            memories[name].merge(m)
+        return {name: m.snapshot() for name, m in memories.items()}
+
+    @classmethod
+    def get_latencies(cls):
+        """
+        {section name: `LatencyHistogram` of its durations in ns}, over all paths and threads.
+        """
+        latencies = {}
+        for path, node in cls._get_tree().items():
+            name = cls.section_names[path[-1]]
+            if name not in latencies:
+                latencies[name] = LatencyHistogram(node.latency.precision)
+            latencies[name].merge(node.latency)
+        return latencies
+
+    @staticmethod
+    def worker_id():
+        """
+        Id of this process among workers (see `merge_profile()`).
+        """
+        return os.getpid()
+
+    @classmethod
+    def get_workers(cls):
+        """
+        Ids of this process and the workers whose profiles were merged.
+        """
+        with cls._lock:
+            return [cls.worker_id()] + [w for w in cls._workers if w != cls.worker_id()]
+
+    @classmethod
+    def _get_tree(cls, worker=None):
+        """
+        Profile tree merged over all threads and workers (or only `worker`),
+        {path of section ids: _ProfileNode}.
+        """
+        with cls._lock:
+            # dict.copy() is atomic, the owning threads may go on updating
+            all_stats = []
+            if worker is None or worker == cls.worker_id():
+                all_stats += [stats.copy() for _, stats in cls._thread_stats]
+                all_stats.append(cls._ended_stats)
+            all_stats += [stats for w, stats in cls._workers.items() if worker is None or w == worker]
+        tree = {}
+        for stats in all_stats:
+            for path, node in stats.items():
+                if path not in tree:
+                    tree[path] = _ProfileNode()
+                tree[path].merge(node)
+        return tree
+
+    @classmethod
+    def get_profile(cls):
+        """
+        Snapshot of the profile tree: {path of section names: SectionStats}.
+        """
+        return {
+            path: SectionStats(
+                path=path, inclusive=node.inclusive * 1e-9, self=(node.inclusive - node.children) * 1e-9,
+                calls=node.calls, min=(node.min or 0) * 1e-9, max=node.max * 1e-9, latency=node.latency,
+                memory=None if node.memory is None else node.memory.snapshot()
+            )
+            for path, node in (
+                (tuple(cls.section_names[s] for s in path), node)
+                for path, node in cls._get_tree().items()
+            )
+        }
+
+    @classmethod
+    def format_profile(cls, profile=None):
+        """
+        Profile tree as table, sub-sections indented below their parents
+        by descending inclusive time.
+        """
+        if profile is None:
+            profile = cls.get_profile()
+        children = defaultdict(list)
+        for path, stats in profile.items():
+            children[path[:-1]].append(stats)
+
+        rows = []
+        def add_rows(path):
+            for stats in sorted(children[path], key=lambda s: -s.inclusive):
+                rows.append((
+                    cls.format_message(len(stats.path) - 1, stats.path[-1]),
+                    '{:.6f}'.format(stats.inclusive), '{:.6f}'.format(stats.self), stats.calls,
+                    '{:.6f}'.format(stats.min), '{:.6f}'.format(stats.max)
+                ))
+                add_rows(stats.path)
+        add_rows(())
+        return format_table(rows, ('name', 'inclusive', 'self', 'calls', 'min', 'max'))
+
+    @classmethod
+    def export_profile(cls):
+        """
+        Profile tree of this process (all threads) in a compact, JSON-serializable form
+        to be merged in another process with `merge_profile()`.
+        """
+        return {
+            'worker': cls.worker_id(),
+            'nodes': [
+                dict(node.to_dict(), path=[cls.section_names[s] for s in path])
+                for path, node in cls._get_tree(cls.worker_id()).items()
+            ],
+        }
+
+    @classmethod
+    def merge_profile(cls, profile, worker=None):
+        """
+        Add an exported profile (see `export_profile()`) to the statistics,
+        kept apart per `worker` (default: the exporting process) for `format_worker_stats()`.
+        """
+        if worker is None:
+            worker = profile['worker']
+        nodes = [
+            (tuple(cls.section_id(name) for name in d['path']), _ProfileNode.from_dict(d))
+            for d in profile['nodes']
+        ]
+        with cls._lock:
+            tree = cls._workers.setdefault(worker, {})
+            for path, node in nodes:
+                if path not in tree:
+                    tree[path] = _ProfileNode()
+                tree[path].merge(node)
+
+    @classmethod
+    def send_profile(cls, queue):
+        """
+        Put the profile of this process on (multiprocessing) `queue`, see `receive_profiles()`.
+        """
+        queue.put(cls.export_profile())
+
+    @classmethod
+    def receive_profiles(cls, queue, n, timeout=None):
+        """
+        Merge `n` profiles sent with `send_profile()` from `queue`.
+        """
+        for _ in range(n):
+            if timeout is None:
+                cls.merge_profile(queue.get())
+            else:
+                cls.merge_profile(queue.get(timeout=timeout))
+
+    @classmethod
+    def format_worker_stats(cls):
+        """
+        Table of total time and calls per section and worker.
+        """
+        rows = []
+        for worker in cls.get_workers():
+            for name, tot, calls in cls.get_stats(worker):
+                rows.append((name, worker, tot, calls))
+        rows.sort(key=lambda r: (r[0], -r[2]))
+        return format_table(rows, ('name', 'worker', 'tot', 'calls'))
+
+    @classmethod
+    def get_stats(cls, worker=None):
+        """
+        Yield (name, total time, calls) per section by descending total time,
+        over all workers or only `worker`.
+        Time spent in recursive calls is counted only once.
+        """
+        tot_time = defaultdict(int)
+        calls = defaultdict(int)
+
+        for path, node in cls._get_tree(worker).items():
+            section = path[-1]
+            calls[section] += node.calls
+            if section not in path[:-1]:
+                # Outermost call
+                tot_time[section] += node.inclusive
 
         l = list(tot_time.items())
         l.sort(key = lambda kv: -kv[1])
-        for name, tot in l:
-            yield (name, tot, calls[name])
+        for section, tot in l:
+            yield (cls.section_names[section], tot * 1e-9, calls[section])
 
     @staticmethod
     def format_message(level, msg):
@@ -96,20 +926,264 @@ class Timer:
             #self.log_callback(s)
         #Timer.log.append(s)
 
+    @staticmethod
+    def current_sections():
+        """
+        Names of the sections open in the current thread / task, innermost last.
+        """
+        entry = _open_sections.get()
+        return () if entry is None else tuple(Timer.section_names[s] for s in entry[2])
+
+    @staticmethod
+    def _propagate_peak(entry, peak):
+        """
+        Make the innermost open section (from `entry` outwards) recording memory see
+        the traced memory `peak`, as `tracemalloc.reset_peak()` is about to hide it.
+        """
+        while entry is not None:
+            memory = entry[3]
+            if memory is not None:
+                memory[3] = max(memory[3], peak)
+                return
+            entry = entry[6]
+
+    @staticmethod
+    def _memory_start(outer):
+        """
+        [RSS, allocated blocks, traced memory (None if not tracing), highest traced peak of sub-sections]
+        """
+        traced = None
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            Timer._propagate_peak(outer, peak)
+            tracemalloc.reset_peak()
+        return [_rss(), sys.getallocatedblocks(), traced, 0]
+
+    @staticmethod
+    def _memory_stop(outer, node, start):
+        rss0, blocks0, traced0, sub_peak = start
+        rss = _rss()
+        blocks = sys.getallocatedblocks()
+        peak = None
+        if traced0 is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], sub_peak)
+            Timer._propagate_peak(outer, peak)
+            peak -= traced0
+
+        if node.memory is None:
+            node.memory = _MemoryNode()
+        node.memory.add(0 if rss is None or rss0 is None else rss - rss0, peak, blocks - blocks0)
+
     def __enter__(self):
-        Timer.events.append(
-            Timer.Event(event = Timer.START, name = self.name,
-                t = time.time(), level = Timer.level)
-        )
+        # Nothing is stored on self, the same Timer may be entered concurrently
+        outer = _open_sections.get()
+        memory = Timer._memory_start(outer) if self.memory else None
+        thread = _get_ident()
+        task = None if _get_running_loop() is None else _current_task_id()
+        section = self.id
         #self.log_message('{}...'.format(self.name))
-        #self.t = time.time()
-        Timer.level += 1
+        path = (section,) if outer is None else outer[2] + (section,)
+        t = _perf_counter_ns()
+        _open_sections.set((section, t, path, memory, thread, task, outer))
+        if Timer.sampler is not None:
+            Timer._thread_sections[thread] = path
+
+    def __exit__(self, exc_type, exc, tb):
+        t = _perf_counter_ns()
+        section, t0, path, memory, thread, task, outer = _open_sections.get()
+        _open_sections.set(outer)
+        if Timer.sampler is not None:
+            Timer._thread_sections[thread] = None if outer is None else outer[2]
+
+        try:
+            stats = Timer._local.stats
+        except AttributeError:
+            stats = Timer._get_thread_stats()
+        try:
+            node = stats[path]
+        except KeyError:
+            node = stats[path] = _ProfileNode()
+        node.latency.record(t - t0)
+        if outer is not None:
+            try:
+                parent = stats[outer[2]]
+            except KeyError:
+                parent = stats[path[:-1]] = _ProfileNode()
+            parent.children += t - t0
+        if memory is not None:
+            Timer._memory_stop(outer, node, memory)
+
+        # `EventBuffer.append()` inlined
+        events = Timer.events
+        i = next(events._slots)
+        j = i % events._size
+        if j == i or events._accept():
+            _pack_section(events._buffer, j * _SECTION_SIZE, section, len(path) - 1, t0, t, thread, task or 0)
+        events._recorded = i + 1
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every `interval` seconds in a background thread
+    and attributes the innermost function to the innermost `Timer` section open in that
+    thread (threads outside of sections are not sampled). Shows which functions
+    the time in big sections goes to without wrapping them.
+
+    Sections only entered before `start()` are recognized after their thread enters
+    or leaves another one. With asyncio, samples go to the section of the task
+    that last entered or left one in the thread.
+
+    >>> import time
+    >>> def busy():
+    ...     t = time.perf_counter()
+    ...     while time.perf_counter() - t < .2:
+    ...         pass
+    >>> with SamplingProfiler(interval=.005) as profiler:
+    ...     with Timer("busy section"):
+    ...         busy()
+    >>> profiler.get_hot_functions()[0][:2]
+    (('busy section',), 'busy')
+    >>> Timer.reset()
+    """
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        # {path of section ids: {(qualified name, filename, line): samples}}
+        self.samples = defaultdict(lambda: defaultdict(int))
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if Timer.sampler is not None:
+            raise RuntimeError('A SamplingProfiler is already running')
+        Timer._thread_sections.clear()
+        Timer.sampler = self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        Timer.sampler = None
+        Timer._thread_sections.clear()
+
+    def __enter__(self):
+        return self.start()
 
     def __exit__(self, *args):
-        Timer.level -= 1
-        Timer.events.append(
-            Timer.Event(event = Timer.STOP, name = self.name,
-                t = time.time(), level = Timer.level)
+        self.stop()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.n_samples += 1
+            for thread, frame in sys._current_frames().items():
+                path = Timer._thread_sections.get(thread)
+                if thread == own or path is None:
+                    continue
+                code = frame.f_code
+                function = (getattr(code, 'co_qualname', code.co_name), code.co_filename, code.co_firstlineno)
+                self.samples[path][function] += 1
+
+    def get_hot_functions(self, n=10):
+        """
+        List of (path of section names, function, filename, line, samples, share of the
+        section's samples), the `n` functions with most samples per section,
+        sections by descending number of samples.
+        """
+        samples = list(self.samples.items())
+        samples.sort(key=lambda kv: -sum(kv[1].values()))
+        result = []
+        for path, functions in samples:
+            names = tuple(Timer.section_names[s] for s in path)
+            total = sum(functions.values())
+            for (function, filename, line), count in sorted(functions.items(), key=lambda kv: -kv[1])[:n]:
+                result.append((names, function, filename, line, count, count / total))
+        return result
+
+    def format_hot_functions(self, n=10):
+        return format_table(
+            [
+                (' > '.join(path), function, '{}:{}'.format(os.path.basename(filename), line),
+                    count, '{:.1%}'.format(share))
+                for path, function, filename, line, count, share in self.get_hot_functions(n)
+            ],
+            ('section', 'function', 'location', 'samples', 'share')
         )
-        #self.log_message('{} done ({:.3f})'.format(self.name, time.time() - self.t))
 
+def init_worker(queue):
+    """
+    Initializer for worker processes (eg. `multiprocessing.Pool(initializer=init_worker, initargs=(queue,))`)
+    sending their `Timer` profile on `queue` when they exit normally (eg. after `Pool.close()` and
+    `Pool.join()`, not on `Pool.terminate()`). Collect them with `Timer.receive_profiles()`.
+    """
+    from multiprocessing.util import Finalize
+
+    # Do not send back what was inherited from the parent, nor nest in its open sections
+    Timer.reset()
+    _open_sections.set(None)
+    with Timer._lock:
+        Timer._thread_stats[:] = [(t, s) for t, s in Timer._thread_stats if t == threading.get_ident()]
+    # Before the queue's own finalizers (exitpriority 10) close it
+    Finalize(None, Timer.send_profile, args=(queue,), exitpriority=20)
+
+# Comma separated fnmatch patterns of names of modules to instrument when they are imported
+INSTRUMENT_ENV = 'TIMER_INSTRUMENT'
+
+class _InstrumentingLoader:
+    """
+    Loader delegating to `loader`, instrumenting the module after executing it.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        Timer.instrument(module)
+
+    def __getattr__(self, name):
+        # get_source() etc.
+        return getattr(self.loader, name)
+
+class InstrumentingFinder:
+    """
+    Meta path finder instrumenting modules whose names match one of `patterns` as they are imported.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def find_spec(self, name, path, target=None):
+        if not Timer._matches(name, self.patterns):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _InstrumentingLoader(spec.loader)
+                return spec
+        return None
+
+def install_import_hook(patterns):
+    """
+    Instrument (see `Timer.instrument()`) modules whose names match one of the fnmatch
+    `patterns` when they are imported, and those already imported.
+    Returns the finder installed in `sys.meta_path`.
+    """
+    finder = InstrumentingFinder(patterns)
+    sys.meta_path.insert(0, finder)
+    for name, module in list(sys.modules.items()):
+        if module is not None and name != __name__ and Timer._matches(name, patterns):
+            Timer.instrument(module)
+    return finder
+
+if os.environ.get(INSTRUMENT_ENV):
+    install_import_hook([p.strip() for p in os.environ[INSTRUMENT_ENV].split(',') if p.strip()])